@@ -0,0 +1,47 @@
+"""
+Deploy bundles.
+
+A bundle is the file form of a fetch: a header naming the refs it carries
+and the commits the receiver must already have, followed by a pack of the
+objects in between.  Built once on the client and copied to each target,
+``git fetch <bundle> <refspec>`` indexes the pack and updates the ref with
+no negotiation or pack generation on the remote.  A target that lacks a
+prerequisite commit refuses the bundle rather than ending up incomplete.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+from dulwich.pack import write_pack_objects
+
+BUNDLE_SIGNATURE = '# v2 git bundle\n'
+
+
+def write_bundle(f, object_store, refs, prerequisites):
+    """
+    Write a bundle to the file object ``f``.
+
+    Parameters:
+        object_store  - object store holding the objects
+        refs          - dict of ref name -> sha carried by the bundle
+        prerequisites - list of commit shas the receiver already has, the
+                        objects reachable from them are left out
+
+    Returns the number of objects in the pack.
+    """
+    f.write(BUNDLE_SIGNATURE)
+    for sha in prerequisites:
+        f.write('-{0}\n'.format(sha))
+    for name, sha in sorted(refs.iteritems()):
+        f.write('{0} {1}\n'.format(sha, name))
+    f.write('\n')
+
+    objects = object_store.generate_pack_contents(prerequisites,
+                                                  refs.values())
+    write_pack_objects(f, objects)
+    return len(objects)
@@ -11,8 +11,9 @@ __date__ = '2013-09-08'
 __license__ = 'GPL v2.0 (or later)'
 
 from dulwich.config import StackedConfig
-import subprocess
+import os
 import sys
+import json
 import logging
 
 # Native git call
@@ -22,6 +23,45 @@ GIT_CALL = '/usr/bin/git'
 DEFAULT_CLIENT_HOOK = 'default-client-push.py'
 DEFAULT_TARGET_HOOK = 'default-target-pull.py'
 
+# Default number of targets synced concurrently
+DEFAULT_PARALLEL = 10
+
+# Seconds a deploy lock is held before it is considered stale
+DEFAULT_LOCK_LEASE = 3600
+
+# Values git config accepts as true for boolean items
+GIT_TRUE = ('true', 'yes', 'on', '1')
+
+# Git config files read by StackedConfig.default_backends
+CONFIG_PATHS = ['~/.gitconfig', '/etc/gitconfig']
+
+# Snapshot of the parsed git config, relative to the top level directory
+CONFIG_SNAPSHOT = '.git/deploy/config.snapshot'
+
+# Timing spans of each command are appended to this JSON lines file,
+# relative to the top level directory
+TRACE_LOG = '.git/deploy/trace.jsonl'
+
+# Stats of profiled commands are written to this directory, relative to
+# the top level directory, and the share of commands profiled without
+# --profile is read from this environment variable
+PROFILE_DIR = '.git/deploy/profiles'
+PROFILE_RATE_ENV = 'GIT_DEPLOY_PROFILE_RATE'
+
+# Append-only journal of deploys, relative to the top level directory
+JOURNAL = '.git/deploy/journal'
+
+# Unix socket of the git-deploy daemon, relative to the top level directory
+DAEMON_SOCKET = '.git/deploy/daemon.sock'
+
+# Bump when the snapshot layout changes to force a re-read
+CONFIG_SNAPSHOT_VERSION = 1
+
+# Host groups are referenced in deploy.target as "@<name>" and defined by
+# the git config item "deploy-group.<name>.hosts"
+GROUP_PREFIX = '@'
+GROUP_SECTION = 'deploy-group'
+
 # Codes emitted on exit conditions
 exit_codes = {
     1: 'Operation failed.  Exiting.',
@@ -38,6 +78,8 @@ exit_codes = {
     12: 'Tagging failed. Exiting',
     13: 'Revert tag not found. Exiting',
     14: 'Commit failed, does not match HEAD. Exiting.',
+    15: 'Uncommitted changes or untracked files would be overwritten, '
+        'commit or move them or use --force. Exiting.',
     19: 'Missing system configuration item "deploy.client-path". Exiting.',
     20: 'Cannot find top level directory for the git repository. Exiting.',
     21: 'Missing system configuration item "hook-dir". Exiting.',
@@ -61,6 +103,10 @@ exit_codes = {
     37: 'Missing system configuration item "key-path". Exiting.',
     38: 'Missing system configuration item "test-repo-path". Exiting.',
     40: 'Failed to run sync script. Exiting.',
+    41: 'Target pull failed on one or more hosts. Exiting.',
+    42: 'SCP transfer to the target failed. Exiting.',
+    43: 'Client push to the remote failed. Exiting.',
+    44: 'Deploy halted, a wave exceeded the maximum failure rate. Exiting.',
     50: 'Failed to read the .deploy file. Exiting.',
     60: 'Invalid git deploy action. Exiting.',
 }
@@ -101,55 +147,241 @@ def set_log(args, out, err):
                          datefmt='%b-%d %H:%M:%S'))
     log.addHandler(handler)
     log.setLevel(level)
+    return handler
 
 
-def configure(**kwargs):
-    """ Parse configuration from git config """
+# Define the key names, git config names, and error codes
+CONFIG_ELEMENTS = {
+    'hook_dir': ('deploy', 'hook-dir', 21),
+    'path': ('deploy', 'path', 23),
+    'user': ('deploy', 'user', 24),
+    'target': ('deploy', 'target', 25),
+    'repo_name': ('deploy', 'tag-prefix', 22),
+    'remote': ('deploy', 'remote', 26),
+    'branch': ('deploy', 'branch', 27),
+    'client_path': ('deploy', 'client-path', 19),
+    'user.name': ('user', 'name', 28),
+    'user.email': ('user', 'email', 29),
+    'deploy.key_path': ('deploy', 'key-path', 37),
+    'deploy.test_repo': ('deploy', 'test-repo-path', 38),
+}
+
+# Optional elements, their git config names and defaults
+OPTIONAL_CONFIG_ELEMENTS = {
+    'parallel': ('deploy', 'parallel', DEFAULT_PARALLEL),
+    'target_timeout': ('deploy', 'target-timeout', None),
+    'lock_lease': ('deploy', 'lock-lease', DEFAULT_LOCK_LEASE),
+    'relay_fanout': ('deploy', 'relay-fanout', 0),
+    'ship_pack': ('deploy', 'ship-pack', False),
+    'canary': ('deploy', 'canary', 0),
+    'wave_size': ('deploy', 'wave-size', 0),
+    'wave_pause': ('deploy', 'wave-pause', 0),
+    'health_check': ('deploy', 'health-check', None),
+    'max_failure_rate': ('deploy', 'max-failure-rate', 0),
+}
+
+
+def find_top_dir(path=None):
+    """
+    Returns the top level directory of the git repository containing
+    ``path``, the current directory by default, or None outside of a
+    repository.  Equivalent to `git rev-parse --show-toplevel`.
+    """
+    path = os.path.abspath(path or os.getcwd())
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def config_sources():
+    """
+    Returns the state of the git config files read by ``configure`` as a
+    list of [path, mtime, size], mtime and size are None for missing files.
+    """
+    sources = []
+    for path in CONFIG_PATHS:
+        path = os.path.expanduser(path)
+        try:
+            st = os.stat(path)
+            sources.append([path, st.st_mtime, st.st_size])
+        except OSError:
+            sources.append([path, None, None])
+    return sources
+
+
+def read_git_config():
+    """
+    Read the configuration elements from git config.  Returns a dict of
+    the elements that are set, with ``targets`` holding the expanded list
+    of deploy targets.
+    """
     sc = StackedConfig(StackedConfig.default_backends())
+    values = {}
+
+    elements = dict(CONFIG_ELEMENTS)
+    elements.update(OPTIONAL_CONFIG_ELEMENTS)
+    for key, value in elements.iteritems():
+        try:
+            values[key] = sc.get(value[0], value[1])
+        except KeyError:
+            pass
+
+    if 'target' in values:
+        values['targets'] = get_targets(sc, values['target'])
+
+    return values
+
+
+def _config_element_names():
+    """ Snapshots are only valid for the config elements they were read for """
+    return sorted(CONFIG_ELEMENTS.keys() + OPTIONAL_CONFIG_ELEMENTS.keys())
+
+
+def load_config_snapshot(path, sources):
+    """
+    Returns the values stored in the config snapshot at ``path`` if it was
+    taken from the same state of the config files, None otherwise.
+    """
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if snapshot.get('version') != CONFIG_SNAPSHOT_VERSION or \
+            snapshot.get('sources') != sources or \
+            snapshot.get('elements') != _config_element_names():
+        return None
+    return _decode_json_strings(snapshot.get('values'))
+
+
+def _decode_json_strings(value):
+    """ Convert the unicode strings produced by json.load to str """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_decode_json_strings(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_decode_json_strings(key), _decode_json_strings(item))
+                    for key, item in value.iteritems())
+    return value
+
+
+def save_config_snapshot(path, sources, values):
+    """ Write the config snapshot, failure only costs a re-read """
+    tmp_path = path + '.tmp'
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': CONFIG_SNAPSHOT_VERSION,
+                'sources': sources,
+                'elements': _config_element_names(),
+                'values': values,
+            }, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.debug('{0} :: Could not write config snapshot: {1}'.format(
+            __name__, str(e)))
+
+
+def configure(**kwargs):
+    """
+    Parse configuration from git config
+
+    The parsed values are kept in a snapshot under .git/deploy/ and reused
+    until one of the git config files changes.
+    """
     config = {}
 
     # Get top level directory of project
-    proc = subprocess.Popen(['git', 'rev-parse', '--show-toplevel'],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    config['top_dir'] = proc.communicate()[0].strip()
+    config['top_dir'] = find_top_dir()
 
-    if proc.returncode != 0:
+    if config['top_dir'] is None:
         exit_code = 20
         log.error("{0} :: {1}".format(__name__, exit_codes[exit_code]))
         sys.exit(exit_code)
 
     config['deploy_file'] = config['top_dir'] + '/.git/.deploy'
 
-    # Define the key names, git config names, and error codes
-    config_elements = {
-        'hook_dir': ('deploy', 'hook-dir', 21),
-        'path': ('deploy', 'path', 23),
-        'user': ('deploy', 'user', 24),
-        'target': ('deploy', 'target', 25),
-        'repo_name': ('deploy', 'tag-prefix', 22),
-        'remote': ('deploy', 'remote', 26),
-        'branch': ('deploy', 'branch', 27),
-        'client_path': ('deploy', 'client-path', 19),
-        'user.name': ('user', 'name', 28),
-        'user.email': ('user', 'email', 29),
-        'deploy.key_path': ('deploy', 'key-path', 37),
-        'deploy.test_repo': ('deploy', 'test-repo-path', 38),
-    }
+    snapshot_path = os.path.join(config['top_dir'], CONFIG_SNAPSHOT)
+    sources = config_sources()
+    values = load_config_snapshot(snapshot_path, sources)
+
+    if values is None:
+        values = read_git_config()
+        save_config_snapshot(snapshot_path, sources, values)
 
     # Assign the values of each git config element
-    for key, value in config_elements.iteritems():
+    for key, value in CONFIG_ELEMENTS.iteritems():
         try:
             # Override with kwargs if the attribute exists
             if key in kwargs:
                 config[key] = kwargs[key]
             else:
-                config[key] = sc.get(value[0], value[1])
+                config[key] = values[key]
         except KeyError:
             exit_code = value[2]
             log.error("{0} :: {1}".format(__name__, exit_codes[exit_code]))
             sys.exit(exit_code)
 
+    for key, value in OPTIONAL_CONFIG_ELEMENTS.iteritems():
+        config[key] = kwargs.get(key, values.get(key, value[2]))
+
+    config['parallel'] = int(config['parallel'])
+    config['lock_lease'] = int(config['lock_lease'])
+    config['relay_fanout'] = int(config['relay_fanout'])
+    config['ship_pack'] = str(config['ship_pack']).lower() in GIT_TRUE
+    config['wave_pause'] = float(config['wave_pause'])
+    if config['target_timeout'] is not None:
+        config['target_timeout'] = float(config['target_timeout'])
+
+    # Expand the target into the list of hosts to deploy to, the first
+    # host is the primary target which holds the deploy lock
+    if 'target' in kwargs:
+        config['targets'] = get_targets(
+            StackedConfig(StackedConfig.default_backends()),
+            config['target'])
+    else:
+        config['targets'] = values['targets']
+
+    if not config['targets']:
+        exit_code = 25
+        log.error("{0} :: {1}".format(__name__, exit_codes[exit_code]))
+        sys.exit(exit_code)
+    config['target'] = config['targets'][0]
+
     config['sync_dir'] = '{0}/sync'.format(config['hook_dir'])
 
     return config
+
+
+def get_targets(sc, target):
+    """
+    Expand the value of ``deploy.target`` into a list of hosts.  The value
+    is either a comma or whitespace separated list of hosts or the name of
+    a host group prefixed with "@", e.g. ``@web`` which reads the hosts
+    from the git config item ``deploy-group.web.hosts``.
+    """
+    hosts = []
+    for name in target.replace(',', ' ').split():
+        if name.startswith(GROUP_PREFIX):
+            try:
+                group = sc.get((GROUP_SECTION, name[len(GROUP_PREFIX):]),
+                               'hosts')
+            except KeyError:
+                log.error('{0} :: Unknown host group "{1}".'.format(
+                    __name__, name))
+                continue
+            hosts.extend(group.replace(',', ' ').split())
+        else:
+            hosts.append(name)
+
+    # Drop duplicates, preserving order
+    seen = set()
+    return [host for host in hosts if not (host in seen or seen.add(host))]
@@ -0,0 +1,312 @@
+"""
+Resident git-deploy server.
+
+``git deploy daemon`` keeps the Sartoris instance, with its parsed config,
+repository handle and pooled SSH connections, alive in one process and
+serves commands over a Unix socket in the deploy directory.  While it runs
+``git deploy`` forwards each command to it instead of starting cold.
+
+A request is one JSON line holding the parsed command line arguments and
+the variables of CLIENT_ENV set in the environment of the client.  The
+daemon answers with JSON lines of the form {"out": text} and
+{"err": text}, streamed as the command runs, followed by
+{"exit_code": code}.  Commands are run one at a time.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import sys
+import json
+import socket
+import traceback
+from argparse import Namespace
+
+from config import log, set_log, exit_codes, config_sources, \
+    PROFILE_RATE_ENV
+
+# Seconds without a request after which the daemon exits
+DEFAULT_IDLE_TIMEOUT = 3600
+
+# Request asking the daemon to exit
+SHUTDOWN = 'shutdown'
+
+# Environment variables of the client that apply to its command
+CLIENT_ENV = (PROFILE_RATE_ENV,)
+
+
+class DaemonError(Exception):
+    """ The daemon went away in the middle of a request """
+
+
+def dispatch(args, out, env=None):
+    """
+    Run the Sartoris method named by ``args.method``.  ``env`` is the
+    environment of the client, the environment of this process by default.
+    Returns a value that can be understood by :func:`sys.exit`.
+    """
+    from sartoris import Sartoris, SartorisError
+    from tracing import summarize, TRACED_COMMANDS
+
+    # Inline call to functionality - if Sartoris does not possess this
+    #  attribute flag with logger
+    if not args.method:
+        log.error(exit_codes[3])
+        return
+
+    # One instance for the whole command, the singleton's __init__ resets
+    # the state of the command, e.g. the tag it synced
+    s = Sartoris()
+
+    if not hasattr(s, args.method):
+        log.error(exit_codes[60])
+        return
+
+    if not callable(getattr(s, args.method)):
+        log.error(__name__ + ' :: No function called %(method)s.' % {
+            'method': args.method})
+        return
+
+    if env is None:
+        env = os.environ
+
+    # Profile on request or for a sampled share of runs
+    profiler = None
+    if args.profile or env.get(PROFILE_RATE_ENV):
+        from profiling import sampled, start_profile
+        if args.profile or sampled(env.get(PROFILE_RATE_ENV)):
+            profiler = start_profile()
+
+    try:
+        getattr(s, args.method)(args)
+    except SartorisError as e:
+        log.error(e.message)
+        return e.exit_code
+    finally:
+        if profiler:
+            from profiling import finish_profile
+            path = s._get_profile_path(args.method)
+            finish_profile(profiler, path,
+                           args.profile_top if args.profile else 0, out)
+            log.info('Profile written to {0}'.format(path))
+
+        # Read only commands are traced on request only
+        if args.trace or args.method in TRACED_COMMANDS:
+            spans = s._write_trace(args.method)
+        else:
+            s._tracer.reset()
+        if args.trace:
+            for line in summarize(spans):
+                out.write(line + '\n')
+
+
+class _Client(object):
+    """
+    Connection to the client of a request.  Once the client has gone away
+    messages are dropped, so that the command still runs to the end, e.g.
+    releasing the deploy lock.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.gone = False
+
+    def send(self, message):
+        if self.gone:
+            return
+        try:
+            _send(self.conn, message)
+        except socket.error as e:
+            self.gone = True
+            log.warning('{0} :: Client went away, dropping its output: '
+                        '{1}'.format(__name__, str(e)))
+
+
+class _SocketStream(object):
+    """ File-like object forwarding writes as messages of one kind """
+
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+
+    def write(self, text):
+        if text:
+            self.client.send({self.kind: text})
+
+    def flush(self):
+        pass
+
+
+def _send(conn, message):
+    conn.sendall(json.dumps(message) + '\n')
+
+
+def _read_message(conn):
+    """ Read one JSON line from ``conn``, None if it is closed first """
+    data = []
+    while True:
+        chunk = conn.recv(4096)
+        if not chunk:
+            return None
+        data.append(chunk)
+        if chunk.endswith('\n'):
+            return json.loads(''.join(data))
+
+
+def _handle(conn):
+    """ Serve one request, returns False if the daemon should exit """
+    request = _read_message(conn)
+    if request is None:
+        return True
+    if request.get(SHUTDOWN):
+        _send(conn, {'exit_code': 0})
+        return False
+
+    args = Namespace(**dict((str(key), value) for key, value in
+                            request['args'].iteritems()))
+    client = _Client(conn)
+    out = _SocketStream(client, 'out')
+    err = _SocketStream(client, 'err')
+
+    level = log.level
+    handler = set_log(args, out, err)
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+        exit_code = dispatch(args, out, request.get('env', {}))
+    except Exception:
+        err.write(traceback.format_exc())
+        exit_code = 1
+    finally:
+        sys.stdout = stdout
+        log.removeHandler(handler)
+        log.setLevel(level)
+
+    client.send({'exit_code': exit_code})
+    return True
+
+
+def serve(path, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """
+    Serve requests on the Unix socket at ``path`` until a shutdown request
+    or until no request arrived for ``idle_timeout`` seconds.  The config
+    is read again when one of the git config files changes.
+    """
+    from sartoris import Sartoris
+
+    if is_running(path):
+        log.error('{0} :: A daemon is already listening on {1}'.format(
+            __name__, path))
+        return 1
+
+    # Warm up the config and the repository handle
+    s = Sartoris()
+    s._get_repo()
+    sources = config_sources()
+
+    # Left behind by a daemon that did not exit cleanly
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(8)
+    server.settimeout(idle_timeout)
+
+    log.info('{0} :: Listening on {1}'.format(__name__, path))
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                log.info('{0} :: Idle for {1}s, exiting'.format(
+                    __name__, idle_timeout))
+                break
+
+            if config_sources() != sources:
+                log.info('{0} :: Git config changed, reloading'.format(
+                    __name__))
+                s._configure()
+                sources = config_sources()
+
+            conn.settimeout(None)
+            try:
+                if not _handle(conn):
+                    break
+            except socket.error as e:
+                log.error('{0} :: Client went away: {1}'.format(
+                    __name__, str(e)))
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        os.remove(path)
+        if s._ssh_pool is not None:
+            s._ssh_pool.close()
+    return 0
+
+
+def _connect(path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except socket.error:
+        conn.close()
+        raise
+    return conn
+
+
+def is_running(path):
+    """ True if a daemon accepts connections on ``path`` """
+    try:
+        _connect(path).close()
+    except socket.error:
+        return False
+    return True
+
+
+def request(path, args, out, err):
+    """
+    Run the command described by ``args`` on the daemon listening on
+    ``path``, relaying its output.  Returns the exit code of the command.
+
+    Raises socket.error if no daemon accepts the connection, in which
+    case nothing has run, and DaemonError if the daemon goes away while
+    the command runs.
+    """
+    conn = _connect(path)
+    try:
+        env = dict((name, os.environ[name]) for name in CLIENT_ENV
+                   if name in os.environ)
+        _send(conn, {'args': vars(args), 'env': env})
+        for line in conn.makefile('r'):
+            message = json.loads(line)
+            if 'out' in message:
+                out.write(message['out'])
+            elif 'err' in message:
+                err.write(message['err'])
+            elif 'exit_code' in message:
+                return message['exit_code']
+    finally:
+        conn.close()
+    raise DaemonError('The git-deploy daemon exited during the command.')
+
+
+def shutdown(path):
+    """ Ask the daemon listening on ``path`` to exit """
+    conn = _connect(path)
+    try:
+        _send(conn, {SHUTDOWN: True})
+        _read_message(conn)
+    finally:
+        conn.close()
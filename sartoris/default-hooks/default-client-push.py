@@ -7,8 +7,12 @@ Defult sync script that performs push from client.  The expected ops
 are the following:
 
     cd $GIT_DEPLOY_HOME
-    /usr/bin/git push origin master
-    /usr/bin/git push --tags
+    /usr/bin/git push $REMOTE $BRANCH refs/tags/$TAG
+
+The branch and the new deploy tag are sent in a single push, so there is
+one pack negotiation with the remote and historical tags are not pushed.
+
+Usage: default-client-push.py <remote> <branch> [<tag>]
 
 """
 
@@ -16,29 +20,34 @@ import os
 import sys
 import subprocess
 
-from sartoris.config import GIT_CALL
+from sartoris.config import GIT_CALL, find_top_dir
 
 
 def main():
 
-    # Move to root - TODO, dulwich
-    proc = subprocess.Popen([GIT_CALL, 'rev-parse', '--show-toplevel'],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    os.chdir(proc.communicate()[0].strip())
+    if len(sys.argv) < 3:
+        sys.stderr.write(__doc__)
+        return 1
 
-    # Push to remote -  TODO, dulwich
-    #                   TODO, use git config for remote/branch
-    proc = subprocess.Popen([GIT_CALL, 'push', 'origin', 'master'],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    proc.communicate()
+    remote, branch = sys.argv[1:3]
+    tag = sys.argv[3] if len(sys.argv) > 3 else None
+
+    # Move to root
+    os.chdir(find_top_dir())
 
-    # Push tags - TODO, dulwich
-    proc = subprocess.Popen([GIT_CALL, 'push', '--tags'],
+    # Push the branch and the deploy tag to remote
+    refspecs = [branch]
+    if tag:
+        refspecs.append('refs/tags/{0}'.format(tag))
+
+    proc = subprocess.Popen([GIT_CALL, 'push', remote] + refspecs,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
-    proc.communicate()
+    out, err = proc.communicate()
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+
+    return proc.returncode
 
 
 def cli():
@@ -7,7 +7,15 @@ Defult sync script that performs pull at the target.  The expected ops
 are the following:
 
     cd $GIT_DEPLOY_HOME
-    /usr/bin/git pull origin master
+    /usr/bin/git fetch --no-tags $REMOTE +refs/tags/$TAG:refs/tags/$TAG
+    /usr/bin/git reset --hard $TAG
+
+Only the deploy tag, or the branch tip when no tag is given, is fetched.
+The working tree is then moved straight to that commit, which rewrites
+only the files that differ from the current checkout.  The remote may be
+a remote name, a repository URL or the path of a bundle.
+
+Usage: default-target-pull.py <remote> <branch> [<tag>]
 
 """
 
@@ -15,23 +23,46 @@ import os
 import sys
 import subprocess
 
-from sartoris.config import GIT_CALL
+from sartoris.config import GIT_CALL, find_top_dir
 
 
-def main():
-
-    # Move to root - TODO, dulwich
-    proc = subprocess.Popen([GIT_CALL, 'rev-parse', '--show-toplevel'],
+def git(*args):
+    """ Run a git command, returns its exit code """
+    proc = subprocess.Popen([GIT_CALL] + list(args),
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
-    os.chdir(proc.communicate()[0].strip())
+    out, err = proc.communicate()
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    return proc.returncode
 
-    # Pull from remote -    TODO, dulwich
-    #                       TODO, use git config for remote/branch
-    proc = subprocess.Popen([GIT_CALL, 'pull', 'origin', 'master'],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    proc.communicate()
+
+def main():
+
+    if len(sys.argv) < 3:
+        sys.stderr.write(__doc__)
+        return 1
+
+    remote, branch = sys.argv[1:3]
+    tag = sys.argv[3] if len(sys.argv) > 3 else None
+
+    # Move to root
+    os.chdir(find_top_dir())
+
+    # Fetch the single ref that was synced
+    if tag:
+        refspec = '+refs/tags/{0}:refs/tags/{0}'.format(tag)
+        target = 'refs/tags/{0}^{{commit}}'.format(tag)
+    else:
+        refspec = 'refs/heads/{0}'.format(branch)
+        target = 'FETCH_HEAD'
+
+    ret = git('fetch', '--no-tags', remote, refspec)
+    if ret:
+        return ret
+
+    # Move the working tree to the fetched commit
+    return git('reset', '--hard', '--quiet', target)
 
 
 def cli():
@@ -0,0 +1,299 @@
+"""
+Streaming diffs between two trees.
+
+Changes are produced file by file as generators of output lines so that
+memory use is bounded by the largest single file rather than the size of
+the whole diff.  The name only and name status summaries only use the tree
+entries and never read blob contents, the diffstat reads one pair of blobs
+at a time.  Blob sizes are checked from the object headers before a blob
+is read, so blobs too large to diff are never loaded.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+from itertools import islice
+from subprocess import Popen, PIPE
+
+from dulwich.diff_tree import tree_changes, CHANGE_ADD, CHANGE_DELETE
+from dulwich.objects import S_ISGITLINK
+from dulwich.patch import unified_diff, is_binary
+
+from config import log
+
+# Blobs larger than this, in bytes, are reported as differing but not diffed
+MAX_DIFF_BLOB_SIZE = 16 * 1024 * 1024
+
+# Widest +/- graph of a diffstat line, wider graphs are scaled down
+STAT_GRAPH_WIDTH = 50
+
+# Status letters used in summaries, as in `git diff --name-status`
+CHANGE_STATUS = {
+    CHANGE_ADD: 'A',
+    CHANGE_DELETE: 'D',
+}
+
+
+def _shortid(sha):
+    return sha[:7] if sha else '0' * 7
+
+
+class ObjectSizes(object):
+    """
+    Callable returning the size of an object of ``store`` without loading
+    it.  The sizes are read from the object headers by a `git cat-file
+    --batch-check` process kept open until ``close`` is called, objects of
+    stores that are not on disk are measured by loading them.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._proc = None
+        self._started = False
+
+    def _start(self):
+        self._started = True
+        if not hasattr(self.store, 'path'):
+            return
+        try:
+            self._proc = Popen(['git', '--git-dir',
+                                os.path.dirname(self.store.path),
+                                'cat-file', '--batch-check'],
+                               stdin=PIPE, stdout=PIPE)
+        except OSError as e:
+            log.debug('{0} :: Could not start git cat-file: {1}'.format(
+                __name__, str(e)))
+
+    def __call__(self, sha):
+        if not self._started:
+            self._start()
+        if self._proc is not None:
+            self._proc.stdin.write(sha + '\n')
+            self._proc.stdin.flush()
+            # "<sha> <type> <size>", or "<sha> missing"
+            fields = self._proc.stdout.readline().split()
+            if len(fields) == 3:
+                return int(fields[2])
+        return len(self.store.get_raw(sha)[1])
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc = None
+
+
+def _content(store, mode, sha, max_size, sizes):
+    """
+    Contents of the blob ``sha``, None if it is larger than ``max_size``.
+    The size is checked with ``sizes``, an ObjectSizes, before the blob is
+    read.
+    """
+    if sha is None:
+        return ''
+    if S_ISGITLINK(mode):
+        return 'Submodule commit {0}\n'.format(sha)
+
+    if max_size is not None and sizes(sha) > max_size:
+        return None
+    return store.get_raw(sha)[1]
+
+
+def _diff_contents(store, change, max_blob_size, sizes):
+    """
+    The old and new contents of ``change``, None for both if either is
+    binary or too large to diff.
+    """
+    old_content = _content(store, change.old.mode, change.old.sha,
+                           max_blob_size, sizes)
+    if old_content is None:
+        return None, None
+    new_content = _content(store, change.new.mode, change.new.sha,
+                           max_blob_size, sizes)
+
+    if new_content is None or \
+            is_binary(old_content) or is_binary(new_content):
+        return None, None
+    return old_content, new_content
+
+
+def _hunks(old_content, new_content, old_name, new_name):
+    """
+    Unified diff of two contents as git writes it.  Unlike dulwich's
+    unified_diff, a context line without a newline is marked as such and
+    the hunk ranges of empty files start at 0, so that `git apply` takes it.
+    """
+    for line in unified_diff(old_content.splitlines(True),
+                             new_content.splitlines(True), old_name,
+                             new_name):
+        if line.startswith('@@'):
+            old_range, new_range = line.split()[1:3]
+            line = '@@ {0} {1} @@\n'.format(_git_range(old_range),
+                                            _git_range(new_range))
+        elif line.startswith(' ') and not line.endswith('\n'):
+            line += '\n\\ No newline at end of file\n'
+        yield line
+
+
+def _git_range(hunk_range):
+    """ "-1,0" -> "-0,0", git counts empty ranges from the line before """
+    start, count = hunk_range[1:].split(',')
+    if count == '0':
+        start = int(start) - 1
+    return '{0}{1},{2}'.format(hunk_range[0], start, count)
+
+
+def iter_name_only(store, old_tree, new_tree):
+    """ Yields the path of each changed file """
+    for change in tree_changes(store, old_tree, new_tree):
+        yield '{0}\n'.format(change.new.path or change.old.path)
+
+
+def iter_name_status(store, old_tree, new_tree):
+    """
+    Yields a status letter and path for each changed file followed by a
+    count of changed files.
+    """
+    count = 0
+    for change in tree_changes(store, old_tree, new_tree):
+        count += 1
+        yield '{0}\t{1}\n'.format(CHANGE_STATUS.get(change.type, 'M'),
+                                  change.new.path or change.old.path)
+    yield ' {0} file(s) changed\n'.format(count)
+
+
+def _change_counts(store, change, max_blob_size, sizes):
+    """
+    Returns (insertions, deletions) for ``change`` or, for binary and
+    oversized blobs, (None, (old size, new size)).
+    """
+    old_content, new_content = _diff_contents(store, change, max_blob_size,
+                                              sizes)
+    if old_content is None:
+        return None, tuple(sizes(sha) if sha and not S_ISGITLINK(mode)
+                           else 0 for _, mode, sha in (change.old,
+                                                       change.new))
+
+    insertions = deletions = 0
+    lines = _hunks(old_content, new_content, 'a', 'b')
+    # Skip the file names
+    for line in islice(lines, 2, None):
+        if line.startswith('+'):
+            insertions += 1
+        elif line.startswith('-'):
+            deletions += 1
+    return insertions, deletions
+
+
+def iter_stat(store, old_tree, new_tree, max_blob_size=MAX_DIFF_BLOB_SIZE,
+              width=STAT_GRAPH_WIDTH):
+    """
+    Yields a diffstat as `git diff --stat` does: the number of changed
+    lines and a +/- graph per file, followed by totals.  Blobs are read one
+    change at a time and only if they are at most ``max_blob_size``, only
+    the counts are kept until the end.
+    """
+    sizes = ObjectSizes(store)
+    try:
+        counts = [((change.new.path or change.old.path),
+                   _change_counts(store, change, max_blob_size, sizes))
+                  for change in tree_changes(store, old_tree, new_tree)]
+    finally:
+        sizes.close()
+
+    text = [lines for _, lines in counts if lines[0] is not None]
+    name_width = max([len(path) for path, _ in counts] or [0])
+    count_width = max([len(str(a + d)) for a, d in text] or [1])
+    most = max([a + d for a, d in text] or [0])
+    scale = min(1.0, float(width) / most) if most else 1.0
+
+    insertions = deletions = 0
+    for path, (added, removed) in counts:
+        if added is None:
+            yield ' {0:<{1}} | Bin {2} -> {3} bytes\n'.format(
+                path, name_width, removed[0], removed[1])
+            continue
+
+        insertions += added
+        deletions += removed
+        plus, minus = int(added * scale), int(removed * scale)
+        # Every changed file shows at least one mark
+        if added and not plus:
+            plus = 1
+        if removed and not minus:
+            minus = 1
+        yield ' {0:<{1}} | {2:>{3}} {4}{5}\n'.format(
+            path, name_width, added + removed, count_width, '+' * plus,
+            '-' * minus).rstrip(' \n') + '\n'
+
+    yield ' {0} file{1} changed, {2} insertion{3}(+), {4} deletion{5}(-)\n' \
+        .format(len(counts), '' if len(counts) == 1 else 's',
+                insertions, '' if insertions == 1 else 's',
+                deletions, '' if deletions == 1 else 's')
+
+
+def iter_change_patch(store, change, max_blob_size=MAX_DIFF_BLOB_SIZE,
+                      sizes=None):
+    """
+    Yields the patch for a single ``TreeChange`` in the format of `git
+    diff`, which `git apply` accepts.  Binary blobs, and blobs larger than
+    ``max_blob_size``, are reported as differing only.  ``sizes`` is the
+    ObjectSizes used to check blob sizes, by default one for this change.
+    """
+    if sizes is None:
+        sizes = ObjectSizes(store)
+        try:
+            for line in iter_change_patch(store, change, max_blob_size,
+                                          sizes):
+                yield line
+        finally:
+            sizes.close()
+        return
+
+    old_path, old_mode, old_sha = change.old
+    new_path, new_mode, new_sha = change.new
+
+    old_name = 'a/' + old_path if old_path else '/dev/null'
+    new_name = 'b/' + new_path if new_path else '/dev/null'
+
+    yield 'diff --git a/{0} b/{1}\n'.format(old_path or new_path,
+                                            new_path or old_path)
+    index_line = 'index {0}..{1}'.format(_shortid(old_sha),
+                                         _shortid(new_sha))
+    if old_mode is None:
+        yield 'new file mode {0:o}\n'.format(new_mode)
+    elif new_mode is None:
+        yield 'deleted file mode {0:o}\n'.format(old_mode)
+    elif old_mode != new_mode:
+        yield 'old mode {0:o}\n'.format(old_mode)
+        yield 'new mode {0:o}\n'.format(new_mode)
+    else:
+        index_line += ' {0:o}'.format(new_mode)
+    yield index_line + '\n'
+
+    old_content, new_content = _diff_contents(store, change, max_blob_size,
+                                              sizes)
+    if old_content is None:
+        yield 'Binary files {0} and {1} differ\n'.format(old_name, new_name)
+        return
+
+    for line in _hunks(old_content, new_content, old_name, new_name):
+        yield line
+
+
+def iter_patch(store, old_tree, new_tree, max_blob_size=MAX_DIFF_BLOB_SIZE):
+    """ Yields the patch between two trees one file at a time """
+    sizes = ObjectSizes(store)
+    try:
+        for change in tree_changes(store, old_tree, new_tree):
+            for line in iter_change_patch(store, change, max_blob_size,
+                                          sizes):
+                yield line
+    finally:
+        sizes.close()
@@ -0,0 +1,156 @@
+"""
+Concurrent execution of remote operations across many deploy targets.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+from time import time
+from Queue import Queue, Empty
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+# Exit code recorded for a host when the remote call raised an exception
+FAILED_CALL_EXIT_CODE = 255
+
+# Exit code recorded for a host whose call ran past its deadline
+TIMED_OUT_EXIT_CODE = 124
+
+# Seconds between deadline checks while calls are queued but not started
+POLL_INTERVAL = 0.1
+
+
+def _timed_call(func, host):
+    """
+    Call ``func(host)`` and return its result dict extended with the
+    elapsed wall clock time.  Exceptions are folded into the result so
+    that one failing host does not abort the others.
+    """
+    start = time()
+    try:
+        result = dict(func(host))
+        result.setdefault('exit_code', 0)
+    except Exception as e:
+        result = {
+            'stdout': [],
+            'stderr': [str(e)],
+            'exit_code': FAILED_CALL_EXIT_CODE,
+        }
+    result['elapsed'] = time() - start
+    return host, result
+
+
+def run_on_hosts(func, hosts, workers, timeout=None, on_timeout=None):
+    """
+    Run ``func(host)`` for every host on a bounded pool of worker threads.
+
+    Parameters:
+        func        - callable returning a dict with 'stdout', 'stderr' and
+                      'exit_code' keys
+        hosts       - list of host names
+        workers     - maximum number of concurrent calls
+        timeout     - seconds a call may run, wall clock, before its host
+                      is failed with TIMED_OUT_EXIT_CODE.  None waits for
+                      every call to return.
+        on_timeout  - called with the host of each call that timed out, to
+                      abandon it, e.g. by closing its connection
+
+    Returns an OrderedDict of host -> result in the order of ``hosts``.
+    """
+    results = {}
+    started = {}
+    done = Queue()
+
+    def call(host):
+        started[host] = time()
+        done.put(_timed_call(func, host))
+
+    if hosts:
+        pool = ThreadPool(max(1, min(int(workers), len(hosts))))
+        try:
+            for host in hosts:
+                pool.apply_async(call, (host,))
+
+            while len(results) < len(hosts):
+                wait = None
+                if timeout:
+                    wait = POLL_INTERVAL
+                    now = time()
+                    for host, start in started.items():
+                        if host in results:
+                            continue
+                        if now - start < timeout:
+                            wait = min(wait, start + timeout - now)
+                            continue
+                        results[host] = {
+                            'stdout': [],
+                            'stderr': ['Timed out after {0}s'.format(
+                                timeout)],
+                            'exit_code': TIMED_OUT_EXIT_CODE,
+                            'elapsed': now - start,
+                        }
+                        if on_timeout:
+                            on_timeout(host)
+                    if len(results) == len(hosts):
+                        break
+
+                try:
+                    host, result = done.get(timeout=wait)
+                except Empty:
+                    continue
+                # Late results of calls that timed out are dropped
+                results.setdefault(host, result)
+        finally:
+            # Workers of abandoned calls are not waited for
+            pool.terminate()
+
+    return OrderedDict((host, results[host]) for host in hosts)
+
+
+def assign_sources(hosts, sources, fanout):
+    """
+    Assign each host a source to fetch from.  The origin, represented by
+    None, and each of ``sources`` serve up to ``fanout`` hosts, hosts are
+    spread across sources round robin.  Hosts beyond that capacity, or all
+    hosts when ``fanout`` is 0, fetch from the origin.
+
+    Returns a list of (host, source) tuples in the order of ``hosts``.
+    """
+    if not fanout:
+        return [(host, None) for host in hosts]
+
+    servers = [None] + list(sources)
+    assigned = []
+    for i, host in enumerate(hosts):
+        if i < len(servers) * fanout:
+            assigned.append((host, servers[i % len(servers)]))
+        else:
+            assigned.append((host, None))
+    return assigned
+
+
+def failed_hosts(results):
+    """ Return the hosts whose call exited non-zero """
+    return [host for host, result in results.iteritems()
+            if result['exit_code']]
+
+
+def summarize(results):
+    """
+    Produce summary lines for the results of :func:`run_on_hosts`, one per
+    host followed by a totals line.
+    """
+    lines = []
+    for host, result in results.iteritems():
+        lines.append('{0:<30} exit={1:<4} {2:8.3f}s'.format(
+            host, result['exit_code'], result['elapsed']))
+
+    failed = len(failed_hosts(results))
+    lines.append('{0} host(s), {1} succeeded, {2} failed'.format(
+        len(results), len(results) - failed, failed))
+    return lines
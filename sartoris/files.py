@@ -0,0 +1,48 @@
+"""
+Helpers for the append-only files in the deploy directory, such as the tag
+index, the deploy journal and the trace log.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+
+
+def reverse_lines(path, block_size=4096):
+    """
+    Yields the non-empty lines of the file at ``path`` last first, reading
+    it backwards one block at a time.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        partial = ''
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            lines = (f.read(step) + partial).split('\n')
+            # The first line may continue in the previous block
+            partial = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line
+        if partial.strip():
+            yield partial
+
+
+def write_atomic(path, data):
+    """
+    Replace the file at ``path`` with ``data``.  Readers see either the old
+    or the new contents, never a partly written file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
@@ -0,0 +1,152 @@
+"""
+Append-only journal of deploys.
+
+Every sync, revert and abort appends one JSON line to the journal in the
+deploy directory, with the fields of RECORD_FIELDS:
+
+    action      sync, revert or abort
+    tag         the deploy tag created, null if none was
+    sha         HEAD once the action finished
+    user        deploy.user of the deployer
+    targets     host -> "ok", "error" or "skipped"
+    phases      phase -> seconds, from the timing spans of the command
+    outcome     "ok" or "error"
+    exit_code   exit code of the action
+    time        start of the action, seconds since the epoch
+    duration    seconds the action took
+
+The journal answers queries about targets and outcomes, the order of
+deploys is that of the tag index.  These queries read the journal from its
+end, newest first, and stop at the first records that answer them.  Once
+the journal outgrows MAX_JOURNAL_SIZE it is compacted to the newest
+KEEP_RECORDS records plus the last successful deploy to each target.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import json
+
+from config import log
+from files import reverse_lines, write_atomic
+from tracing import OUTCOME_OK
+
+RECORD_FIELDS = ('action', 'tag', 'sha', 'user', 'targets', 'phases',
+                 'outcome', 'exit_code', 'time', 'duration')
+
+# Actions that put a tag on the targets
+DEPLOY_ACTIONS = ('sync', 'revert')
+
+TARGET_SKIPPED = 'skipped'
+
+# Compaction threshold in bytes and the records kept by compaction
+MAX_JOURNAL_SIZE = 1024 * 1024
+KEEP_RECORDS = 1000
+
+
+def make_record(**fields):
+    """ Returns a record with every field of RECORD_FIELDS """
+    unknown = set(fields) - set(RECORD_FIELDS)
+    if unknown:
+        raise ValueError('Unknown journal field(s): {0}'.format(
+            ', '.join(sorted(unknown))))
+    return dict((name, fields.get(name)) for name in RECORD_FIELDS)
+
+
+def phase_durations(spans):
+    """
+    Returns phase -> seconds for ``spans``.  A phase recorded on several
+    targets lasts from the first start to the last end.
+    """
+    bounds = {}
+    for span in spans:
+        start, end = span['start'], span['start'] + span['duration']
+        if span['name'] in bounds:
+            first, last = bounds[span['name']]
+            start, end = min(start, first), max(end, last)
+        bounds[span['name']] = (start, end)
+    return dict((name, round(end - start, 6))
+                for name, (start, end) in bounds.iteritems())
+
+
+def is_deploy_to(record, host=None):
+    """
+    True if ``record`` is a successful deploy, to ``host`` if given
+    """
+    if record['action'] not in DEPLOY_ACTIONS or \
+            record['outcome'] != OUTCOME_OK or not record['tag']:
+        return False
+    return host is None or (record['targets'] or {}).get(host) == OUTCOME_OK
+
+
+class Journal(object):
+    """ The deploy journal at ``path`` """
+
+    def __init__(self, path, max_size=MAX_JOURNAL_SIZE, keep=KEEP_RECORDS):
+        self.path = path
+        self.max_size = max_size
+        self.keep = keep
+
+    def append(self, record):
+        """ Append ``record``, compacting the journal if it grew too big """
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True,
+                               separators=(',', ':')) + '\n')
+
+        if os.path.getsize(self.path) > self.max_size:
+            self.compact()
+
+    def read_newest_first(self):
+        """
+        Lazily yields the records newest first.  Lines that cannot be
+        parsed, e.g. one cut short by a crash, are skipped.
+        """
+        if not os.path.exists(self.path):
+            return
+        for line in reverse_lines(self.path):
+            try:
+                yield make_record(**json.loads(line))
+            except (ValueError, TypeError):
+                log.debug('{0} :: Skipping unreadable journal record: '
+                          '{1}'.format(__name__, line))
+
+    def last_deploy(self, host=None, tag_exists=None):
+        """
+        Returns the newest successful deploy, to ``host`` if given, or
+        None if the journal has none.  Deploys whose tag fails the
+        ``tag_exists`` check, if given, are skipped.
+        """
+        for record in self.read_newest_first():
+            if is_deploy_to(record, host) and \
+                    (tag_exists is None or tag_exists(record['tag'])):
+                return record
+        return None
+
+    def compact(self):
+        """
+        Rewrite the journal with the newest ``keep`` records and, for each
+        target, the record of the last successful deploy to it.
+        """
+        kept = []
+        hosts = set()
+        for number, record in enumerate(self.read_newest_first()):
+            new_hosts = set(host for host in record['targets'] or {}
+                            if host not in hosts and
+                            is_deploy_to(record, host))
+            if number < self.keep or new_hosts:
+                kept.append(record)
+            hosts |= new_hosts
+
+        log.info('{0} :: Compacted the deploy journal to {1} '
+                 'record(s)'.format(__name__, len(kept)))
+        write_atomic(self.path, ''.join(
+            json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n'
+            for record in reversed(kept)))
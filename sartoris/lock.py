@@ -0,0 +1,131 @@
+"""
+Remote deploy lock.
+
+The lock is a file in the deploy directory of the target recording the
+owner, client host, pid and lease expiry as "key=value" lines.  Each
+operation on it is a single shell command so that it costs one round trip
+over SSH.  Acquisition relies on the exclusive create of the shell's
+noclobber option, so of two deployers racing only one succeeds.  A lock
+whose lease has expired is taken over by the next acquirer.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+from pipes import quote
+
+# First line of output of the acquire command
+LOCK_ACQUIRED = 'ACQUIRED'
+LOCK_HELD = 'HELD'
+
+# Prefix of the line carrying the remote clock in read output
+NOW_PREFIX = 'now='
+
+# Create the lock exclusively.  On failure, if the lease of the existing
+# lock has expired, move it aside and retry once.  A lock that turns out
+# to be live once moved, because another deployer replaced the stale lock
+# in between, is linked back in place.
+ACQUIRE_SCRIPT = """lock={path}
+create() {{ ( set -C; printf '%s' {contents} > "$lock" ) 2>/dev/null; }}
+expiry() {{ sed -n 's/^expires=//p' "$1" 2>/dev/null; }}
+if create; then echo {acquired}; exit 0; fi
+now=$(date +%s)
+expires=$(expiry "$lock")
+if [ -n "$expires" ] && [ "$expires" -lt "$now" ]; then
+    stale="$lock.stale.$$"
+    if mv "$lock" "$stale" 2>/dev/null; then
+        expires=$(expiry "$stale")
+        if [ -n "$expires" ] && [ "$expires" -ge "$now" ]; then
+            ln "$stale" "$lock" 2>/dev/null
+        elif create; then
+            rm -f "$stale"; echo {acquired}; exit 0
+        fi
+        rm -f "$stale"
+    fi
+fi
+echo {held}
+cat "$lock" 2>/dev/null
+exit 0"""
+
+# Print the remote clock and the lock contents
+READ_SCRIPT = """echo {now}$(date +%s)
+cat {path} 2>/dev/null
+exit 0"""
+
+# Remove the lock only if it is held by owner
+RELEASE_SCRIPT = """grep -qx {owner_line} {path} 2>/dev/null && rm -f {path}
+exit 0"""
+
+
+def format_lock(owner, host, pid, created, lease):
+    """ Returns the contents of a lock file """
+    return ''.join('{0}={1}\n'.format(key, value) for key, value in (
+        ('owner', owner),
+        ('host', host),
+        ('pid', pid),
+        ('created', int(created)),
+        ('expires', int(created + lease)),
+    ))
+
+
+def parse_lock(lines):
+    """
+    Parse the "key=value" lines of a lock file into a dict, numeric values
+    are converted to int.
+    """
+    lock = {}
+    for line in lines:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        lock[key] = int(value) if value.isdigit() else value
+    return lock
+
+
+def acquire_command(path, contents):
+    return 'sh -c {0}'.format(quote(ACQUIRE_SCRIPT.format(
+        path=quote(path), contents=quote(contents),
+        acquired=LOCK_ACQUIRED, held=LOCK_HELD)))
+
+
+def read_command(path):
+    return 'sh -c {0}'.format(quote(READ_SCRIPT.format(
+        path=quote(path), now=NOW_PREFIX)))
+
+
+def release_command(path, owner):
+    return 'sh -c {0}'.format(quote(RELEASE_SCRIPT.format(
+        path=quote(path), owner_line=quote('owner=' + owner))))
+
+
+def parse_acquire(lines):
+    """
+    Returns a tuple of (acquired, lock) from the output of the acquire
+    command, ``lock`` holds the existing lock if it was not acquired.
+    """
+    if lines and lines[0] == LOCK_ACQUIRED:
+        return True, {}
+    return False, parse_lock(lines[1:])
+
+
+def parse_read(lines):
+    """
+    Returns a tuple of (remote time, lock) from the output of the read
+    command, ``lock`` is empty if there is no lock.
+    """
+    now = None
+    if lines and lines[0].startswith(NOW_PREFIX):
+        now = int(lines[0][len(NOW_PREFIX):])
+        lines = lines[1:]
+    return now, parse_lock(lines)
+
+
+def is_held_by(lock, owner, now):
+    """ True if ``lock`` is owned by ``owner`` and its lease is current """
+    return lock.get('owner') == owner and \
+        (now is None or lock.get('expires', 0) >= now)
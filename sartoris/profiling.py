@@ -0,0 +1,62 @@
+"""
+Profiling of git-deploy commands.
+
+A command run with --profile, or picked by sampling, runs under cProfile.
+Its stats are written to the profiles directory under .git/deploy/ so they
+can be loaded with pstats later, and the hottest functions are printed.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import random
+import pstats
+import cProfile
+
+# Order in which the hottest functions are printed
+SORT_KEY = 'cumulative'
+
+
+def sampled(rate):
+    """
+    True for a random ``rate`` share of calls.  The rate is a fraction
+    such as "0.05" or a percentage such as "5%", unset or invalid rates
+    never sample.
+    """
+    try:
+        rate = str(rate or 0).strip()
+        if rate.endswith('%'):
+            rate = float(rate[:-1]) / 100
+        else:
+            rate = float(rate)
+    except ValueError:
+        return False
+    return random.random() < rate
+
+
+def start_profile():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def finish_profile(profiler, path, top=0, stream=None):
+    """
+    Stop ``profiler`` and write its stats to ``path``.  If ``top`` is
+    non-zero the ``top`` hottest functions are printed to ``stream``.
+    """
+    profiler.disable()
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    profiler.dump_stats(path)
+
+    if top:
+        stats = pstats.Stats(path, stream=stream)
+        stats.sort_stats(SORT_KEY).print_stats(top)
@@ -12,21 +12,35 @@ __date__ = '2013-09-08'
 __license__ = 'GPL v2.0 (or later)'
 
 import os
+import sys
 import stat
-import paramiko
-import socket
+import shutil
 from re import search
+import socket
 import subprocess
-from time import time
+from time import time, sleep
 from datetime import datetime
+from itertools import islice
+from functools import wraps
 from collections import OrderedDict
+from pipes import quote
 
 from dulwich.repo import Repo
-from dulwich.objects import Tag, Commit, parse_timezone
+from dulwich.lru_cache import LRUCache
+from dulwich.objects import Tag, Commit, S_ISGITLINK, parse_timezone
 from dulwich.diff_tree import tree_changes
 
 from config import log, configure, exit_codes, DEFAULT_CLIENT_HOOK, \
-    DEFAULT_TARGET_HOOK
+    DEFAULT_TARGET_HOOK, TRACE_LOG, PROFILE_DIR, JOURNAL
+from tagindex import TagIndex
+from journal import Journal, make_record, phase_durations, TARGET_SKIPPED
+from tracing import Tracer, OUTCOME_OK, OUTCOME_ERROR
+from lock import format_lock, acquire_command, read_command, \
+    release_command, parse_acquire, parse_read, is_held_by
+
+# SSH (paramiko), the worker pool, dulwich.index and diff output are only
+# imported by the commands that use them so that local commands such as
+# show_tag and log_deploys start quickly.
 
 
 class SartorisError(Exception):
@@ -40,6 +54,29 @@ class SartorisError(Exception):
         return self._exit_code
 
 
+def journaled(action):
+    """
+    Decorates the Sartoris method of ``action`` to append a record of each
+    call to the deploy journal, whatever its outcome.
+    """
+    def decorator(method):
+        @wraps(method)
+        def journaled_method(self, *args, **kwargs):
+            self._results = None
+            start = time()
+            exit_code = 1
+            try:
+                exit_code = method(self, *args, **kwargs) or 0
+                return exit_code
+            except SartorisError as e:
+                exit_code = e.exit_code
+                raise
+            finally:
+                self._write_journal(action, exit_code, start)
+        return journaled_method
+    return decorator
+
+
 def remove_readonly(fn, path, excinfo):
     """
     Modifies path to writable for recursive path removal.
@@ -53,6 +90,73 @@ def remove_readonly(fn, path, excinfo):
         os.remove(path)
 
 
+def _index_seconds(value):
+    """ Whole seconds of an index time stamp, a float or (secs, nsecs) """
+    if isinstance(value, tuple):
+        return value[0]
+    return int(value)
+
+
+def stat_matches_entry(st, entry):
+    """
+    Returns True if the stat result ``st`` of a file matches its dulwich
+    index entry, in which case the file is assumed to be unchanged.
+    """
+    from dulwich.index import cleanup_mode
+
+    ctime, mtime, _, ino, mode, _, _, size = entry[:8]
+    return st.st_size == size and \
+        st.st_ino == ino and \
+        cleanup_mode(st.st_mode) == mode and \
+        int(st.st_mtime) == _index_seconds(mtime) and \
+        int(st.st_ctime) == _index_seconds(ctime)
+
+
+def blob_from_path(path, st):
+    """
+    Returns a dulwich Blob of the file at ``path`` as git would store it,
+    the target for a symlink, given its lstat result ``st``.
+    """
+    from dulwich.objects import Blob
+
+    if stat.S_ISLNK(st.st_mode):
+        return Blob.from_string(os.readlink(path))
+    with open(path, 'rb') as f:
+        return Blob.from_string(f.read())
+
+
+def is_real_dir(path):
+    """ True if ``path`` is a directory and not a symlink to one """
+    return os.path.isdir(path) and not os.path.islink(path)
+
+
+def parent_dirs(path):
+    """ The parent directories of the relative ``path``, top first """
+    parts = path.split('/')[:-1]
+    return ['/'.join(parts[:i + 1]) for i in xrange(len(parts))]
+
+
+def remove_path(path):
+    """ Remove the file, symlink or directory tree at ``path`` """
+    if is_real_dir(path):
+        shutil.rmtree(path, onerror=remove_readonly)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def run_command(args):
+    """
+    Run ``args`` like subprocess.call and return its exit code.  The output
+    and errors of the command are copied to sys.stdout as they arrive, so
+    that under the daemon they reach the client instead of its own stdout.
+    """
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    for line in iter(proc.stdout.readline, ''):
+        sys.stdout.write(line)
+    return proc.wait()
+
+
 class Sartoris(object):
 
     # Pattern for git-deploy tags
@@ -73,6 +177,12 @@ class Sartoris(object):
     # Default tag message
     DEFAULT_COMMIT_MSG = 'Sartoris Commit'
 
+    # Maximum number of decoded objects held in the object cache
+    OBJECT_CACHE_SIZE = 1000
+
+    # Shortest sha prefix resolved, as git's minimum abbreviation
+    SHA_PREFIX_LENGTH = 4
+
     # class instance
     __instance = None
 
@@ -86,13 +196,32 @@ class Sartoris(object):
         # Stores tag state
         self._tag = None
 
+        # Target results of the last roll out, for the deploy journal
+        self._results = None
+
     def __new__(cls, *args, **kwargs):
         """ This class is Singleton, return only one instance """
         if not cls.__instance:
             cls.__instance = super(Sartoris, cls).__new__(cls, *args, **kwargs)
 
+            # Timing spans of the current command
+            cls.__instance._tracer = Tracer()
+
             # Call config
-            cls.__instance._configure(**kwargs)
+            with cls.__instance._tracer.span('config'):
+                cls.__instance._configure(**kwargs)
+
+            # Persistent SSH connections to deploy targets, these outlive
+            # repeated calls to __init__ on the singleton
+            cls.__instance._ssh_pool = None
+
+            # Cache of ref target sha -> peeled commit sha
+            cls.__instance._peeled_tags = {}
+
+            # Shared repository handle, see _get_repo
+            cls.__instance._repo = None
+            cls.__instance._repo_key = None
+            cls.__instance._object_cache = None
 
             log.info('{0} :: Config - {1}'.format(__name__,
                      str(cls.__instance.config)))
@@ -101,86 +230,181 @@ class Sartoris(object):
     def _configure(self, **kwargs):
         self.config = configure(**kwargs)
 
-    def _check_lock(self):
-        """ Returns boolean flag on lock file existence """
-        cmd = "ls {0}{1}{2}".format(
-            self.config['path'],
-            self.DEPLOY_DIR,
-            self._get_lock_file_name())
+    def _get_repo(self):
+        """
+        Returns the repository handle shared by all operations.  It is
+        opened lazily and re-opened, dropping the object cache, when the
+        top level directory changes or packed-refs has been rewritten since
+        it was opened.  Loose refs are always read from disk by dulwich.
+        """
+        top_dir = self.config['top_dir']
+        try:
+            st = os.stat(os.path.join(top_dir, '.git', 'packed-refs'))
+            packed_refs = (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            packed_refs = None
 
-        log.debug('{0} :: Executing - "{1}"'.format(__name__, cmd))
-        ret = self.ssh_command_target(cmd)
+        if self._repo is None or self._repo_key != (top_dir, packed_refs):
+            self._repo = Repo(top_dir)
+            self._repo_key = (top_dir, packed_refs)
+            self._object_cache = LRUCache(self.OBJECT_CACHE_SIZE)
 
-        # Pull the lock file handle from
+        return self._repo
+
+    def _get_object(self, sha):
+        """
+        Returns the decoded object for ``sha`` through the bounded LRU
+        object cache of the shared repository handle.
+        """
+        _repo = self._get_repo()
         try:
-            file_handle = ret['stdout'][0].split('/')[-1].strip()
-        except (IndexError, ValueError):
-            log.debug('{0} :: Could not extract '
-                      'the lock file name.'.format(__name__))
-            return False
+            return self._object_cache[sha]
+        except KeyError:
+            obj = _repo[sha]
+            self._object_cache[sha] = obj
+            return obj
 
-        if file_handle == self._get_lock_file_name():
-            return True
-        else:
+    def _get_ssh_pool(self):
+        """
+        Returns the pool of SSH connections to deploy targets, paramiko is
+        imported on first use.
+        """
+        if self._ssh_pool is None:
+            from ssh import SSHConnectionPool
+            self._ssh_pool = SSHConnectionPool()
+        return self._ssh_pool
+
+    def _get_lock_path(self):
+        return '{0}{1}{2}'.format(self.config['path'],
+                                  self.DEPLOY_DIR,
+                                  self._get_lock_file_name())
+
+    def _check_lock(self):
+        """
+        Returns boolean flag on whether the lock file exists, is held by
+        this user and its lease has not expired
+        """
+        with self._tracer.span('lock_check'):
+            ret = self.ssh_command_target(
+                read_command(self._get_lock_path()))
+        now, lock = parse_read(ret['stdout'])
+
+        if not lock:
+            log.debug('{0} :: No lock file found.'.format(__name__))
             return False
 
+        return is_held_by(lock, self.config['user'], now)
+
     def _get_lock_file_name(self):
-        return self.LOCK_FILE_HANDLE + '-' + self.config['user']
+        return self.LOCK_FILE_HANDLE
 
-    def _create_lock(self):
+    def _acquire_lock(self):
         """
-        Create a lock file
+        Atomically create the lock file in the deploy directory unless it
+        is already held, in one round trip to the target.  The lock records
+        the user, client host, pid and a lease after which it is stale.
 
-        Write the user name to the lock file in the dploy directory.
+        Returns a tuple of (acquired, lock), ``lock`` describes the holder
+        of the existing lock when it was not acquired.
         """
         log.info('{0} :: SSH Lock create.'.format(__name__))
 
-        cmd = "touch {0}{1}{2}".format(
-            self.config['path'],
-            self.DEPLOY_DIR,
-            self._get_lock_file_name())
-        self.ssh_command_target(cmd)
+        contents = format_lock(self.config['user'], socket.gethostname(),
+                               os.getpid(), time(), self.config['lock_lease'])
+        with self._tracer.span('lock_create'):
+            ret = self.ssh_command_target(
+                acquire_command(self._get_lock_path(), contents))
+        return parse_acquire(ret['stdout'])
 
     def _remove_lock(self):
-        """ Remove the lock file """
-        cmd = "rm {0}{1}{2}".format(
-            self.config['path'],
-            self.DEPLOY_DIR,
-            self._get_lock_file_name())
-        self.ssh_command_target(cmd)
+        """ Remove the lock file if it is held by this user """
+        with self._tracer.span('lock_remove'):
+            self.ssh_command_target(release_command(self._get_lock_path(),
+                                                    self.config['user']))
 
     def _get_commit_sha_for_tag(self, tag):
         """ Obtain the commit sha of an associated tag
-                e.g. `git rev-list $TAG | head -n 1` """
-        # @TODO replace with dulwich
+                e.g. `git rev-list $TAG | head -n 1`
 
-        cmd = "git rev-list {0}".format(tag)
-        proc = subprocess.Popen(cmd.split(),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        result = proc.communicate()[0].split('\n')
+        The tag is resolved and peeled in-process.  Besides tags it may name
+        a branch, a remote branch, a full ref or a unique sha prefix of at
+        least 4 characters.  Peeled shas are cached per
+        process keyed on the object the ref points to, so a moved tag is
+        resolved again.
+        """
+        if not tag:
+            raise SartorisError(message=exit_codes[8], exit_code=8)
 
-        if not proc.returncode and len(result) > 0:
-            return result[0].strip()
-        else:
+        _repo = self._get_repo()
+
+        sha = None
+        for ref in ('refs/tags/' + tag, tag, 'refs/heads/' + tag,
+                    'refs/remotes/' + tag):
+            try:
+                sha = _repo.refs[ref]
+                break
+            except KeyError:
+                continue
+
+        if sha is None:
+            sha = self._expand_sha(tag)
+
+        if sha is None:
             raise SartorisError(message=exit_codes[8], exit_code=8)
 
+        if sha not in self._peeled_tags:
+            commit, _ = self._peel_tag(sha)
+            if commit is None:
+                raise SartorisError(message=exit_codes[8], exit_code=8)
+            self._peeled_tags[sha] = commit.id
+
+        return self._peeled_tags[sha]
+
+    def _expand_sha(self, prefix):
+        """
+        Returns the object sha starting with ``prefix``, None if there is
+        no such object or the prefix is ambiguous or too short.  Unless the
+        sha is complete the object store is scanned, as git does.
+        """
+        _repo = self._get_repo()
+        prefix = prefix.lower()
+        if len(prefix) == 40:
+            return prefix if prefix in _repo else None
+        if not self.SHA_PREFIX_LENGTH <= len(prefix) < 40 or \
+                not search('^[0-9a-f]+$', prefix):
+            return None
+
+        matches = set(sha for sha in _repo.object_store
+                      if sha.startswith(prefix))
+        if len(matches) > 1:
+            log.error('{0} :: Ambiguous sha prefix {1}'.format(
+                __name__, prefix))
+            return None
+        return matches.pop() if matches else None
+
     def _get_latest_deploy_tag(self):
         """
-        Returns the latest tag containing 'sync'
-        Sets self._tag to tag string
+        Returns the latest tag containing 'sync', None if there is none
         """
-        return self._get_deploy_tags()[-1]
+        for tag in self._iter_deploy_tags():
+            return tag
+        return None
 
     def _get_deploy_tags(self):
         """
         Returns the all deploy tags.
         """
-        # 1. Pull last 'num_tags' sync tags
-        # 2. Filter only matched deploy tags
-        tags = self._dulwich_get_tags().keys()
-        f = lambda x: search(self.config['user'] + '-', x)
-        return filter(f, tags)
+        return list(self._iter_deploy_tags())
+
+    def _iter_deploy_tags(self):
+        """
+        Lazily yields the deploy tags newest first.  Only as much of the tag
+        index is read as the caller consumes.
+        """
+        prefix = self.config['user'] + '-'
+        for _, _, tag, _ in self._iter_tag_entries():
+            if search(prefix, tag):
+                yield tag
 
     def _dulwich_tag(self, tag, author, message=DEFAULT_TAG_MSG):
         """
@@ -192,7 +416,11 @@ class Sartoris(object):
         """
 
         # Open the repo
-        _repo = Repo(self.config['top_dir'])
+        _repo = self._get_repo()
+
+        # The tag index can only be updated incrementally if it is current
+        index = self._get_tag_index()
+        index_current = index.is_current()
 
         # Create the tag object
         tag_obj = Tag()
@@ -207,11 +435,16 @@ class Sartoris(object):
         _repo.object_store.add_object(tag_obj)
         _repo['refs/tags/' + tag] = tag_obj.id
 
+        if index_current:
+            commit = self._get_object(tag_obj.object[1])
+            index.append((tag_obj.tag_time, commit.commit_time, tag,
+                          commit.id))
+
     def _dulwich_reset_to_tag(self, tag=None):
         """
         Resets the HEAD to the commit
         """
-        _repo = Repo(self.config['top_dir'])
+        _repo = self._get_repo()
 
         if not tag:
             sha = _repo.head()
@@ -226,23 +459,89 @@ class Sartoris(object):
     def _dulwich_stage_all(self):
         """
         Stage modified files in the repo
+
+        Files whose stat data matches their index entry are taken to be
+        unchanged and are not read or hashed.  Files deleted from the
+        working tree are removed from the index.  Symlinks are staged as
+        links, whether or not their target exists.
         """
-        _repo = Repo(self.config['top_dir'])
+        from dulwich.index import index_entry_from_stat
 
-        # Iterate through files, those modified will be staged
-        for elem in os.walk(self.config['top_dir']):
-            relative_path = elem[0].split('./')[-1]
-            if not search(r'\.git', elem[0]):
-                files = [relative_path + '/' +
-                         filename for filename in elem[2]]
-                log.info(__name__ + ' :: Staging - {0}'.format(files))
-                _repo.stage(files)
+        _repo = self._get_repo()
+        index = _repo.open_index()
+
+        # Files modified in the same second the index was written may not
+        # show up in their stat data, these are always re-read
+        try:
+            index_mtime = int(os.stat(_repo.index_path()).st_mtime)
+        except OSError:
+            index_mtime = 0
+
+        seen = set()
+        changed = []
+
+        for root, dirs, files in os.walk(_repo.path):
+            # Do not descend into the repository metadata
+            dirs[:] = [d for d in dirs if d != '.git']
+
+            # Symlinks to directories are listed with the directories
+            links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+
+            relative_root = os.path.relpath(root, _repo.path)
+            for filename in files + links:
+                if relative_root == '.':
+                    path = filename
+                else:
+                    path = os.path.join(relative_root, filename)
+                seen.add(path)
+
+                try:
+                    st = os.lstat(os.path.join(root, filename))
+                except OSError:
+                    continue
+
+                try:
+                    entry = index[path]
+                except KeyError:
+                    changed.append((path, st))
+                    continue
+
+                if not stat_matches_entry(st, entry) or \
+                        int(st.st_mtime) >= index_mtime:
+                    changed.append((path, st))
+
+        # Submodules are directories in the working tree
+        removed = [name for name in index if name not in seen and
+                   not S_ISGITLINK(index[name][4])]
+
+        log.debug(__name__ + ' :: Staging - {0} changed, {1} removed'.format(
+            len(changed), len(removed)))
+
+        if not (changed or removed):
+            return
+
+        for path, st in changed:
+            try:
+                blob = blob_from_path(os.path.join(_repo.path, path), st)
+            except (IOError, OSError):
+                # Deleted since it was listed
+                removed.append(path)
+                continue
+            _repo.object_store.add_object(blob)
+            index[path] = index_entry_from_stat(st, blob.id, 0)
+
+        for path in removed:
+            try:
+                del index[path]
+            except KeyError:
+                pass
+        index.write()
 
     def _dulwich_commit(self, author, message=DEFAULT_COMMIT_MSG):
         """
         Commit staged files in the repo
         """
-        _repo = Repo(self.config['top_dir'])
+        _repo = self._get_repo()
         commit_id = _repo.do_commit(message, committer=author)
 
         if not _repo.head() == commit_id:
@@ -252,32 +551,151 @@ class Sartoris(object):
         """
         Return the git status
         """
-        _repo = Repo(self.config['top_dir'])
+        _repo = self._get_repo()
         index = _repo.open_index()
         return list(tree_changes(_repo, index.commit(_repo.object_store),
                                  _repo['HEAD'].tree))
 
-    def _dulwich_get_tags(self):
+    def _dulwich_unstaged(self):
         """
-        Get all tags & correspondin commit shas
+        Return the paths whose working tree file differs from the index,
+        including files deleted from the working tree.  Only files whose
+        stat data does not match their index entry are read.
         """
-        _repo = Repo(self.config['top_dir'])
-        tags = _repo.refs.as_dict("refs/tags")
-        tag_keys = tags.keys()
-        commits = [commit for _, commit in tags.iteritems()]
+        _repo = self._get_repo()
+        index = _repo.open_index()
 
-        # Reorder list by commit time
-        # TODO - this is a non dulwich dependency, refactor this to
-        # TODO (cont.) - use timestamps from the repo
-        #
-        ordered_tags = OrderedDict()
+        # As in _dulwich_stage_all, files modified in the same second the
+        # index was written are always re-read
+        try:
+            index_mtime = int(os.stat(_repo.index_path()).st_mtime)
+        except OSError:
+            index_mtime = 0
+
+        unstaged = []
+        for path in index:
+            entry = index[path]
+            if S_ISGITLINK(entry[4]):
+                continue
+
+            full_path = os.path.join(_repo.path, path)
+            try:
+                st = os.lstat(full_path)
+            except OSError:
+                unstaged.append(path)
+                continue
 
-        for commit in self._git_commit_list():
-            if commit in commits:
-                index = commits.index(commit)
-                ordered_tags[tag_keys[index]] = commit
+            if stat_matches_entry(st, entry) and \
+                    int(st.st_mtime) < index_mtime:
+                continue
+            if not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)) \
+                    or blob_from_path(full_path, st).id != entry[8]:
+                unstaged.append(path)
 
-        return ordered_tags
+        return unstaged
+
+    def _peel_tag(self, sha):
+        """
+        Peel the object ``sha`` referenced by a tag down to its commit.
+        Returns a tuple of (commit object, tag time) where tag time is that
+        of the outermost annotated tag or None for lightweight tags.
+        """
+        obj = self._get_object(sha)
+        tag_time = None
+
+        # Annotated tags may point at other tags, peel down to the commit
+        while isinstance(obj, Tag):
+            if tag_time is None:
+                tag_time = obj.tag_time
+            obj = self._get_object(obj.object[1])
+
+        if not isinstance(obj, Commit):
+            return None, tag_time
+        return obj, tag_time
+
+    def _dulwich_scan_tags(self):
+        """
+        Read all tags from the repository.  Returns a list of tuples of
+        (tag time, commit time, tag, commit sha) ordered oldest first.
+
+        Tags are peeled to their commit and ordered by tag time, then by
+        commit time and name, so a deploy of an older commit, e.g. after a
+        rollback, is still the latest deploy.  Lightweight tags take the
+        time of their commit.  Only the tag and commit objects are read so
+        the cost scales with the number of tags, not the size of history.
+        """
+        _repo = self._get_repo()
+
+        # Map peeled commit sha -> [(tag time, tag name), ...]
+        tags_by_commit = {}
+        commit_times = {}
+
+        for tag, sha in _repo.refs.as_dict('refs/tags').iteritems():
+            commit, tag_time = self._peel_tag(sha)
+            if commit is None:
+                continue
+            commit_times[commit.id] = commit.commit_time
+            tags_by_commit.setdefault(commit.id, []).append((tag_time, tag))
+
+        entries = []
+        for commit_sha, commit_tags in tags_by_commit.iteritems():
+            commit_time = commit_times[commit_sha]
+            for tag_time, tag in commit_tags:
+                if tag_time is None:
+                    tag_time = commit_time
+                entries.append((tag_time, commit_time, tag, commit_sha))
+
+        entries.sort()
+        return entries
+
+    def _get_tag_index(self):
+        return TagIndex(os.path.join(self.config['top_dir'], '.git'),
+                        os.path.join(self.config['top_dir'],
+                                     self.DEPLOY_DIR))
+
+    def _get_tag_entries(self):
+        """
+        Returns the ordered tag entries, oldest first, from the on-disk tag
+        index.  The index is rebuilt if the tag refs have changed since it
+        was written.
+        """
+        index = self._get_tag_index()
+        entries = index.read()
+
+        if entries is None:
+            log.debug('{0} :: Rebuilding the tag index.'.format(__name__))
+            entries = self._dulwich_scan_tags()
+            index.write(entries)
+
+        return entries
+
+    def _iter_tag_entries(self):
+        """
+        Yields the tag entries newest first, reading the tag index from its
+        end.  A missing, stale or unreadable index is rebuilt.
+        """
+        yielded = 0
+        entries = self._get_tag_index().read_newest_first()
+        if entries is not None:
+            try:
+                for entry in entries:
+                    yield entry
+                    yielded += 1
+                return
+            except (IOError, ValueError):
+                log.debug('{0} :: Unreadable tag index.'.format(__name__))
+                self._get_tag_index().invalidate()
+
+        for entry in islice(reversed(self._get_tag_entries()), yielded,
+                            None):
+            yield entry
+
+    def _dulwich_get_tags(self):
+        """
+        Get all tags & corresponding commit shas, newest first.
+        """
+        return OrderedDict((tag, commit_sha) for _, _, tag, commit_sha
+                           in reversed(self._get_tag_entries()))
 
     def _make_tag(self):
         timestamp = datetime.now().strftime(self.DATE_TIME_TAG_FORMAT)
@@ -287,35 +705,153 @@ class Sartoris(object):
         return '{0} <{1}>'.format(self.config['user.name'],
                                   self.config['user.email'])
 
-    def _git_commit_list(self):
+    def _dulwich_checkout_tree(self, _repo, old_tree, new_tree):
         """
-        Generate an in-order list of commits
+        Move the working tree and index from ``old_tree`` to ``new_tree``.
+        Only paths that differ between the two trees are touched.
         """
-        cmd = 'git log --pretty=oneline'
-        proc = subprocess.Popen(cmd.split(),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        proc_out = proc.communicate()
+        from dulwich.index import index_entry_from_stat
+
+        index = _repo.open_index()
 
-        if proc.returncode != 0:
-            raise SartorisError(message=exit_codes[34], exit_code=34)
+        for change in tree_changes(_repo.object_store, old_tree, new_tree):
+            if change.old.path and change.old.path != change.new.path:
+                full_path = os.path.join(_repo.path, change.old.path)
+                remove_path(full_path)
+                try:
+                    os.removedirs(os.path.dirname(full_path))
+                except OSError:
+                    pass
+                try:
+                    del index[change.old.path]
+                except KeyError:
+                    pass
+
+            if not change.new.path or S_ISGITLINK(change.new.mode):
+                continue
+
+            # A file may replace a directory and a directory a file
+            full_path = os.path.join(_repo.path, change.new.path)
+            parent = os.path.dirname(full_path)
+            for ancestor in parent_dirs(change.new.path):
+                ancestor = os.path.join(_repo.path, ancestor)
+                if not is_real_dir(ancestor):
+                    remove_path(ancestor)
+                    break
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            remove_path(full_path)
+
+            contents = _repo[change.new.sha].as_raw_string()
+            if stat.S_ISLNK(change.new.mode):
+                os.symlink(contents, full_path)
+            else:
+                with open(full_path, 'wb') as f:
+                    f.write(contents)
+                os.chmod(full_path, change.new.mode & 0777)
 
-        commits = [i.split()[0] for i in proc_out[0][:-1].split('\n')]
+            index[change.new.path] = index_entry_from_stat(
+                os.lstat(full_path), change.new.sha, 0, mode=change.new.mode)
 
-        return commits
+        index.write()
 
-    def _git_revert(self, commit_sha):
+    def _dulwich_checkout_conflicts(self, _repo, old_tree, new_tree):
+        """
+        Return the paths whose local state would be lost by moving from
+        ``old_tree``, that of HEAD, to ``new_tree``: changes staged in the
+        index for the paths that change, and untracked or ignored files in
+        the way of the new tree.  Unstaged changes to tracked files are
+        found by _dulwich_unstaged.
+        """
+        index = _repo.open_index()
+        changes = list(tree_changes(_repo.object_store, old_tree, new_tree))
+        removed = set(change.old.path for change in changes
+                      if change.old.path)
+
+        conflicts = set()
+        for change in changes:
+            # The index must still hold the old tree for changed paths
+            if change.old.path:
+                try:
+                    entry = index[change.old.path]
+                except KeyError:
+                    conflicts.add(change.old.path)
+                else:
+                    if entry[8] != change.old.sha or \
+                            entry[4] != change.old.mode:
+                        conflicts.add(change.old.path)
+
+            path = change.new.path
+            if not path or path == change.old.path or \
+                    S_ISGITLINK(change.new.mode):
+                continue
+            if path in index:
+                conflicts.add(path)
+
+            # Files where the new path needs a directory
+            for ancestor in parent_dirs(path):
+                if not is_real_dir(os.path.join(_repo.path, ancestor)):
+                    if ancestor not in removed and \
+                            os.path.lexists(os.path.join(_repo.path,
+                                                         ancestor)):
+                        conflicts.add(ancestor)
+                    break
+
+            full_path = os.path.join(_repo.path, path)
+            if is_real_dir(full_path):
+                # Everything under a replaced directory is removed
+                for root, dirs, files in os.walk(full_path):
+                    for name in files + [d for d in dirs if os.path.islink(
+                            os.path.join(root, d))]:
+                        name = os.path.relpath(os.path.join(root, name),
+                                               _repo.path)
+                        if name not in removed:
+                            conflicts.add(name)
+            elif os.path.lexists(full_path):
+                st = os.lstat(full_path)
+                if not stat.S_ISREG(st.st_mode) and \
+                        not stat.S_ISLNK(st.st_mode) or \
+                        blob_from_path(full_path, st).id != change.new.sha:
+                    conflicts.add(path)
+
+        return sorted(conflicts)
+
+    def _dulwich_revert_to_commit(self, commit_sha, author, message,
+                                  force=False):
         """
-        Perform a no-commit revert
+        Revert to ``commit_sha`` with a single commit on top of HEAD whose
+        tree is that of ``commit_sha``.  The cost depends on the size of the
+        tree difference rather than the number of commits undone.
+
+        Local changes to tracked files, staged or not, and untracked files
+        in the way of the tree would be lost, unless ``force`` is set the
+        revert is refused if there are any.
+
+        Returns False if HEAD already has the tree of ``commit_sha``.
         """
-        cmd = 'git revert --no-commit {0}'.format(commit_sha)
-        proc = subprocess.Popen(cmd.split(),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        proc.communicate()
+        _repo = self._get_repo()
+        head_tree = self._get_object(_repo.head()).tree
+        target_tree = self._get_object(commit_sha).tree
+
+        if head_tree == target_tree:
+            return False
+
+        if not force:
+            conflicts = sorted(set(self._dulwich_unstaged()) | set(
+                self._dulwich_checkout_conflicts(_repo, head_tree,
+                                                 target_tree)))
+            if conflicts:
+                log.error('{0} :: Local changes in: {1}'.format(
+                    __name__, ', '.join(conflicts)))
+                raise SartorisError(message=exit_codes[15], exit_code=15)
 
-        if proc.returncode != 0:
-            raise SartorisError(message=exit_codes[33], exit_code=33)
+        self._dulwich_checkout_tree(_repo, head_tree, target_tree)
+        commit_id = _repo.do_commit(message, committer=author,
+                                    tree=target_tree)
+
+        if not _repo.head() == commit_id:
+            raise SartorisError(message=exit_codes[14], exit_code=14)
+        return True
 
     def start(self, _):
         """
@@ -323,14 +859,19 @@ class Sartoris(object):
             * add a start tag
         """
 
-        # Create lock file - check if it already exists
-        if self._check_lock():
+        # Create lock file - fails if it already exists
+        acquired, lock = self._acquire_lock()
+        if not acquired:
+            log.error('{0} :: Locked by {1} on {2} (pid {3}) until '
+                      '{4}.'.format(__name__, lock.get('owner'),
+                                    lock.get('host'), lock.get('pid'),
+                                    datetime.fromtimestamp(
+                                        lock.get('expires', 0))))
             raise SartorisError(message=exit_codes[2])
 
-        self._create_lock()
-
         return 0
 
+    @journaled('abort')
     def abort(self, _):
         """
             * reset state back to start tag
@@ -350,19 +891,20 @@ class Sartoris(object):
         # @TODO replace with dulwich
 
         if commit_sha:
-            if subprocess.call("git reset --hard {0}".
-                               format(commit_sha).split()):
+            if run_command("git reset --hard {0}".
+                           format(commit_sha).split()):
                 raise SartorisError(message=exit_codes[5], exit_code=5)
-            if subprocess.call("git reset --soft HEAD@{1}".split()):
+            if run_command("git reset --soft HEAD@{1}".split()):
                 raise SartorisError(message=exit_codes[5], exit_code=5)
-            if subprocess.call("git commit -m 'Revert to {0}'".
-                               format(commit_sha).split()):
+            if run_command("git commit -m 'Revert to {0}'".
+                           format(commit_sha).split()):
                 raise SartorisError(message=exit_codes[5], exit_code=5)
 
         # Remove lock file
         self._remove_lock()
         return 0
 
+    @journaled('sync')
     def sync(self, args):
         """
             * add a sync tag
@@ -378,20 +920,20 @@ class Sartoris(object):
 
     def _sync(self, tag, force):
 
+        self._tag = tag
         repo_name = self.config['repo_name']
         sync_script = '{0}/{1}.sync'.format(self.config["sync_dir"], repo_name)
 
         if os.path.exists(sync_script):
             log.info('{0} :: Calling sync script at {1}'.format(__name__,
                                                                 sync_script))
-            proc = subprocess.Popen([sync_script,
-                                     '--repo="{0}"'.format(repo_name),
-                                     '--tag="{0}"'.format(tag),
-                                     '--force="{0}"'.format(force)])
-            proc_out = proc.communicate()[0]
-            log.info(proc_out)
+            with self._tracer.span('sync_script'):
+                returncode = run_command([sync_script,
+                                          '--repo="{0}"'.format(repo_name),
+                                          '--tag="{0}"'.format(tag),
+                                          '--force="{0}"'.format(force)])
 
-            if proc.returncode != 0:
+            if returncode != 0:
                 exit_code = 40
                 log.error("{0} :: {1}".format(__name__, exit_codes[exit_code]))
                 return exit_code
@@ -400,111 +942,459 @@ class Sartoris(object):
             log.debug(__name__ + ' :: Calling default sync.')
 
             try:
-                self._dulwich_tag(tag, self._make_author())
+                with self._tracer.span('tag'):
+                    self._dulwich_tag(tag, self._make_author())
             except Exception as e:
                 log.error(str(e))
                 raise SartorisError(message=exit_codes[12], exit_code=12)
 
-            self._default_sync()
+            from fanout import failed_hosts
+
+            results = self._default_sync(tag)
+
+            failed = failed_hosts(results)
+            if failed:
+                log.error('{0} :: Target pull failed on: {1}'.format(
+                    __name__, ', '.join(failed)))
+                raise SartorisError(message=exit_codes[41], exit_code=41)
 
         self._remove_lock()
         return 0
 
-    def _default_sync(self):
+    def _default_sync(self, tag):
+        from fanout import summarize
 
         #
-        # Call deploy hook on client
+        # Call deploy hook on client, pushes the branch and the new deploy
+        # tag in a single push
         #
-        #   {% PATH %}/.git/deploy/hooks/default-client-push origin master
+        #   {% PATH %}/.git/deploy/hooks/default-client-push origin master \
+        #       $TAG
         #
         log.info('{0} :: Calling default sync - '
                  'pushing changes ... '.format(__name__))
-        proc = subprocess.Popen(['{0}{1}{2}'.format(
-            self.config['client_path'],
-            self.config['hook_dir'],
-            DEFAULT_CLIENT_HOOK),
-            self.config['remote'],
-            self.config['branch']],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        log.info('PUSH -> ' + '; '.join(
-            filter(lambda x: x, proc.communicate())))
+        with self._tracer.span('client_push'):
+            proc = subprocess.Popen(['{0}{1}{2}'.format(
+                self.config['client_path'],
+                self.config['hook_dir'],
+                DEFAULT_CLIENT_HOOK),
+                self.config['remote'],
+                self.config['branch'],
+                tag],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            log.info('PUSH -> ' + '; '.join(
+                filter(lambda x: x, proc.communicate())))
+
+            if proc.returncode != 0:
+                raise SartorisError(message=exit_codes[43], exit_code=43)
 
         #
-        # Call deploy hook on remote
+        # Call deploy hook on each remote target, fetches only the new
+        # deploy tag, from the remote or from an already updated target
         #
         #   ssh user@target {% PATH %}/.git/deploy/hooks/default-client-pull \
-        #       origin master
+        #       origin master $TAG
         #
-        log.info('{0} :: Calling default sync - '
-                 'pulling to target'.format(__name__))
-        cmd = '{0}{1}{2} {3} {4}'.format(self.config['path'],
-                                         self.config['hook_dir'],
-                                         DEFAULT_TARGET_HOOK,
-                                         self.config['remote'],
-                                         self.config['branch'])
-        ret = self.ssh_command_target(cmd)
-        log.info('PULL -> ' + '; '.join(
-            filter(lambda x: x, ret['stdout'])))
-
-    def scp_file(self, source, target, port=22):
+        log.info('{0} :: Calling default sync - pulling to {1} '
+                 'target(s)'.format(__name__, len(self.config['targets'])))
+        results = self._roll_out(tag)
+        self._results = results
+
+        for host, result in results.iteritems():
+            log.info('PULL {0} -> {1}'.format(host, '; '.join(
+                filter(lambda x: x, result['stdout'] + result['stderr']))))
+        for line in summarize(results):
+            log.info('{0} :: {1}'.format(__name__, line))
+
+        skipped = [host for host in self.config['targets']
+                   if host not in results]
+        if skipped:
+            log.error('{0} :: Deploy halted, not updated: {1}'.format(
+                __name__, ', '.join(skipped)))
+            raise SartorisError(message=exit_codes[44], exit_code=44)
+
+        return results
+
+    def _roll_out(self, tag):
         """
-        SCP files via paramiko.
+        Pull ``tag`` to the targets in waves, a canary wave of deploy.canary
+        targets followed by waves of deploy.wave-size targets, each a count
+        or a percentage of the fleet.  Between waves the deploy sleeps for
+        deploy.wave-pause seconds.  If deploy.health-check is set it is run
+        on the targets of each wave and a failing check fails the target.
+
+        Once the failure rate of a wave exceeds deploy.max-failure-rate the
+        remaining waves are skipped.  Returns an OrderedDict of host ->
+        result for the targets that were pulled to.
+        """
+        from fanout import failed_hosts
+        from waves import plan_waves, parse_rate, failure_rate
+
+        waves = plan_waves(self.config['targets'], self.config['canary'],
+                           self.config['wave_size'])
+        max_rate = parse_rate(self.config['max_failure_rate'])
+
+        bundle = None
+        if self.config['ship_pack']:
+            try:
+                with self._tracer.span('bundle'):
+                    bundle = self._build_deploy_bundle(tag)
+            except Exception as e:
+                log.error('{0} :: Could not build the deploy bundle, '
+                          'pulling from the remote - {1}'.format(__name__,
+                                                                 str(e)))
+
+        results = OrderedDict()
+        updated = []
+        try:
+            for number, wave in enumerate(waves, 1):
+                if number > 1 and self.config['wave_pause']:
+                    log.info('{0} :: Pausing {1}s before the next '
+                             'wave'.format(__name__,
+                                           self.config['wave_pause']))
+                    sleep(self.config['wave_pause'])
+
+                log.info('{0} :: Wave {1} of {2}, {3} target(s)'.format(
+                    __name__, number, len(waves), len(wave)))
+                wave_results = self._pull_targets(tag, wave, bundle, updated)
+                if self.config['health_check']:
+                    self._check_health(wave_results)
+
+                failed = failed_hosts(wave_results)
+                updated.extend(host for host in wave if host not in failed)
+                results.update(wave_results)
+
+                rate = failure_rate(wave_results)
+                if rate > max_rate and number < len(waves):
+                    log.error('{0} :: {1:.0%} of wave {2} failed, above the '
+                              'maximum of {3:.0%}.'.format(__name__, rate,
+                                                           number, max_rate))
+                    break
+        finally:
+            if bundle:
+                os.remove(bundle)
+
+        return results
+
+    def _trace_host(self, name, result, **attrs):
+        """ Record the span of a call made on a target by run_on_hosts """
+        self._tracer.add(name, time() - result['elapsed'], result['elapsed'],
+                         OUTCOME_ERROR if result['exit_code'] else OUTCOME_OK,
+                         exit_code=result['exit_code'], **attrs)
+
+    def _write_trace(self, command):
+        """
+        Append the spans of ``command`` to the trace log and start a new
+        trace.  Returns the spans written.
+        """
+        try:
+            return self._tracer.write(
+                os.path.join(self.config['top_dir'], TRACE_LOG), command)
+        except (IOError, OSError) as e:
+            log.error('{0} :: Could not write the trace log: {1}'.format(
+                __name__, str(e)))
+            return []
+        finally:
+            self._tracer.reset()
+
+    def _get_journal(self):
+        return Journal(os.path.join(self.config['top_dir'], JOURNAL))
+
+    def _write_journal(self, action, exit_code, start):
+        """
+        Append the record of ``action``, started at ``start``, to the deploy
+        journal.  Target outcomes are those of the last roll out.
+        """
+        _repo = self._get_repo()
+        tag = self._tag
+        if tag and 'refs/tags/' + tag not in _repo.refs:
+            tag = None
+
+        targets = {}
+        if self._results is not None:
+            for host in self.config['targets']:
+                result = self._results.get(host)
+                if result is None:
+                    targets[host] = TARGET_SKIPPED
+                else:
+                    targets[host] = OUTCOME_ERROR if result['exit_code'] \
+                        else OUTCOME_OK
+
+        try:
+            self._get_journal().append(make_record(
+                action=action,
+                tag=tag,
+                sha=_repo.refs['HEAD'] if 'HEAD' in _repo.refs else None,
+                user=self.config['user'],
+                targets=targets,
+                phases=phase_durations(self._tracer.spans),
+                outcome=OUTCOME_ERROR if exit_code else OUTCOME_OK,
+                exit_code=exit_code,
+                time=round(start, 6),
+                duration=round(time() - start, 6)))
+        except (IOError, OSError) as e:
+            log.error('{0} :: Could not write the deploy journal: {1}'.format(
+                __name__, str(e)))
+
+    def _get_profile_path(self, method):
         """
+        Path of the profile stats of ``method``, named by the tag it synced
+        or by the current time if it did not sync.
+        """
+        return os.path.join(self.config['top_dir'], PROFILE_DIR,
+                            '{0}-{1}.prof'.format(
+                                method, self._tag or datetime.now().strftime(
+                                    self.DATE_TIME_TAG_FORMAT)))
 
-        # Socket connection to remote host
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self.config['target'], port))
+    def _check_health(self, results):
+        """
+        Run the deploy.health-check command in the deploy path of the
+        targets that pulled successfully, failing those where it fails.
+        """
+        from fanout import failed_hosts
+
+        failed = failed_hosts(results)
+        cmd = 'cd {0} && {1}'.format(quote(self.config['path']),
+                                     self.config['health_check'])
+        checks = self._run_on_targets(
+            lambda host: self.ssh_command_target(cmd, target=host),
+            [host for host in results if host not in failed])
+
+        for host, check in checks.iteritems():
+            self._trace_host('health_check', check, host=host)
+            if check['exit_code']:
+                log.error('{0} :: Health check failed on {1}'.format(
+                    __name__, host))
+                result = results[host]
+                result['exit_code'] = check['exit_code']
+                result['stderr'] = result['stderr'] + check['stdout'] + \
+                    check['stderr']
+
+    def _ssh_user(self):
+        """
+        Login on the deploy targets, deploy.user or the current login if
+        that is empty.  Used for every SSH connection of a deploy.
+        """
+        from getpass import getuser
 
-        # Build a SSH transport
-        t = paramiko.Transport(sock)
-        t.start_client()
+        return self.config.get('user') or getuser()
 
-        rsa_key = paramiko.RSAKey.from_private_key_file(
-            self.config['deploy.key_path '])
-        t.auth_publickey(self.config['user.name'], rsa_key)
+    def _relay_url(self, host):
+        """ URL of the deploy repository on a target, for relayed fetches """
+        from ssh import split_target
 
-        # Start a scp channel
-        scp_channel = t.open_session()
+        host, port = split_target(host)
+        return 'ssh://{0}@{1}:{2}{3}'.format(
+            self._ssh_user(), host, port, self.config['path'])
 
-        f = file(source, 'rb')
-        scp_channel.exec_command('scp -v -t %s\n'
-                                 % '/'.join(target.split('/')[:-1]))
-        scp_channel.send('C%s %d %s\n'
-                         % (oct(os.stat(source).st_mode)[-4:],
-                            os.stat(source)[6],
-                            target.split('/')[-1]))
-        scp_channel.sendall(f.read())
+    def _target_hook_command(self, remote, tag):
+        """ Command running the target pull hook, ``remote`` is quoted """
+        return '{0}{1}{2} {3} {4} {5}'.format(
+            self.config['path'],
+            self.config['hook_dir'],
+            DEFAULT_TARGET_HOOK,
+            quote(remote),
+            self.config['branch'],
+            tag)
 
-        # Cleanup
-        f.close()
-        scp_channel.close()
-        t.close()
-        sock.close()
+    def _build_deploy_bundle(self, tag):
+        """
+        Write a bundle carrying ``tag`` to the deploy directory.  The commit
+        of the previous deploy tag is a prerequisite, so the bundle only
+        holds the objects added since.  Returns the bundle path.
+        """
+        from bundle import write_bundle
+
+        _repo = self._get_repo()
+        previous = next((t for t in self._iter_deploy_tags() if t != tag),
+                        None)
+        prerequisites = [self._get_commit_sha_for_tag(previous)] \
+            if previous else []
+
+        path = os.path.join(self.config['top_dir'], self.DEPLOY_DIR,
+                            '{0}.bundle'.format(tag))
+        start = time()
+        with open(path, 'wb') as f:
+            count = write_bundle(f, _repo.object_store,
+                                 {'refs/tags/' + tag:
+                                  _repo.refs['refs/tags/' + tag]},
+                                 prerequisites)
+        log.info('{0} :: Built deploy bundle of {1} object(s), {2} bytes '
+                 'in {3:.2f}s'.format(__name__, count,
+                                      os.path.getsize(path), time() - start))
+        return path
+
+    def _pull_bundle(self, host, bundle, tag):
+        """
+        Copy the deploy bundle to a target and run the target pull hook
+        with the bundle as remote, the copy is removed afterwards.
+        """
+        remote_path = '{0}{1}{2}'.format(self.config['path'],
+                                         self.DEPLOY_DIR,
+                                         os.path.basename(bundle))
+        self.scp_files([(bundle, remote_path)], host=host)
+
+        cmd = '{0}; ret=$?; rm -f {1}; exit $ret'.format(
+            self._target_hook_command(remote_path, tag), quote(remote_path))
+        result = self.ssh_command_target(cmd, target=host)
+        result['source'] = 'bundle'
+        return result
+
+    def _pull_target(self, host, source, bundle, tag):
+        """
+        Pull ``tag`` to one target from its relay ``source``, from the
+        deploy ``bundle`` or from the remote, in that order of preference.
+        """
+        if source:
+            remote = self._relay_url(source)
+        else:
+            remote = self.config['remote']
+            if bundle:
+                try:
+                    result = self._pull_bundle(host, bundle, tag)
+                    if not result['exit_code']:
+                        return result
+                    error = '; '.join(result['stderr'])
+                except Exception as e:
+                    error = str(e)
+                log.error('{0} :: Deploy bundle failed on {1}, pulling from '
+                          'the remote - {2}'.format(__name__, host, error))
+
+        return self.ssh_command_target(
+            self._target_hook_command(remote, tag), target=host)
+
+    def _run_on_targets(self, func, hosts):
+        """
+        Run ``func(host)`` on ``hosts`` concurrently, see
+        :func:`fanout.run_on_hosts`.  A host still running after
+        deploy.target-timeout seconds is failed and its pooled SSH
+        connection closed, which ends the commands running on it.
+        """
+        from fanout import run_on_hosts
+
+        def abandon(host):
+            log.error('{0} :: {1} timed out after {2}s'.format(
+                __name__, host, self.config['target_timeout']))
+            self._get_ssh_pool().discard(host, self._ssh_user(),
+                                         self.config['deploy.key_path'])
 
-    def ssh_command_target(self, cmd):
+        return run_on_hosts(func, hosts, self.config['parallel'],
+                            timeout=self.config['target_timeout'],
+                            on_timeout=abandon)
+
+    def _pull_targets(self, tag, hosts=None, bundle=None, updated=None):
         """
-        Talk to the target via SSHClient
+        Run the target pull hook on ``hosts``, all targets by default.
+        Returns an OrderedDict of host -> result, each result records the
+        'source' it fetched from.
+
+        With deploy.relay-fanout set to N > 0 targets are updated in waves.
+        The first N fetch from the remote, in every later wave the remote
+        and each target updated so far, including the ``updated`` hosts,
+        serve up to N further targets, so the number of waves grows
+        logarithmically with the fleet size.  Only targets that succeeded
+        serve as sources.
+
+        Targets that would fetch from the remote are handed the deploy
+        ``bundle`` instead if one is given, see deploy.ship-pack.
         """
+        from fanout import failed_hosts, assign_sources
+
+        if hosts is None:
+            hosts = self.config['targets']
+        fanout = self.config['relay_fanout']
+        remaining = list(hosts)
+        updated = list(updated or [])
+        results = {}
+
+        while remaining:
+            if fanout:
+                capacity = (len(updated) + 1) * fanout
+            else:
+                capacity = len(remaining)
+            wave, remaining = remaining[:capacity], remaining[capacity:]
+            sources = dict(assign_sources(wave, updated, fanout))
+
+            log.info('{0} :: Pulling to {1} target(s), {2} '
+                     'relayed'.format(__name__, len(wave),
+                                      len(filter(None, sources.values()))))
 
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(
-            self.config['target'],
-            username=self.config['user.name'],
-            key_filename=self.config['deploy.key_path'])
-        stdin, stdout, stderr = ssh.exec_command(cmd)
+            def pull(host):
+                return self._pull_target(host, sources[host], bundle, tag)
 
-        stdout = [line.strip() for line in stdout.readlines()]
-        stderr = [line.strip() for line in stderr.readlines()]
+            wave_results = self._run_on_targets(pull, wave)
+            failed = failed_hosts(wave_results)
 
-        ssh.close()
+            for host, result in wave_results.iteritems():
+                result.setdefault('source',
+                                  sources[host] or self.config['remote'])
+                self._trace_host('target_pull', result, host=host,
+                                 source=result['source'])
+                results[host] = result
+                if host not in failed:
+                    updated.append(host)
 
-        return {
-            'stdout': stdout,
-            'stderr': stderr,
-        }
+        return OrderedDict((host, results[host]) for host in hosts)
 
+    def scp_file(self, source, target, port=22, host=None):
+        """
+        SCP files via paramiko.
+        """
+        return self.scp_files([(source, target)], port=port, host=host)
+
+    def scp_files(self, files, port=22, host=None):
+        """
+        SCP a batch of files to a deploy target, by default the primary
+        target, over the pooled SSH transport.  Files are streamed in
+        chunks and all files bound for one remote directory share a single
+        SCP channel.
+
+        Parameters:
+            files - list of (local path, remote path) tuples
+        """
+        from ssh import scp_send, SCPError
+
+        t = self._get_ssh_pool().transport(host or self.config['target'],
+                                           self._ssh_user(),
+                                           self.config['deploy.key_path'],
+                                           port=port)
+
+        # Group the files by remote directory
+        batches = OrderedDict()
+        for source, target in files:
+            remote_dir, remote_name = os.path.split(target)
+            batches.setdefault(remote_dir or '.', []).append(
+                (source, remote_name))
+
+        start = time()
+        sent = 0
+        try:
+            for remote_dir, batch in batches.iteritems():
+                sent += scp_send(t, batch, remote_dir)
+        except SCPError as e:
+            log.error('{0} :: SCP failed - {1}'.format(__name__, str(e)))
+            raise SartorisError(message=exit_codes[42], exit_code=42)
+
+        elapsed = max(time() - start, 1e-6)
+        log.info('{0} :: SCP sent {1} file(s), {2} bytes in {3:.2f}s '
+                 '({4:.0f} bytes/sec)'.format(__name__, len(files), sent,
+                                              elapsed, sent / elapsed))
+        return sent
+
+    def ssh_command_target(self, cmd, target=None, timeout=None):
+        """
+        Talk to the target over a pooled SSH connection, ``target`` defaults
+        to the primary deploy target.
+        """
+        return self._get_ssh_pool().exec_command(
+            target or self.config['target'],
+            self._ssh_user(),
+            self.config['deploy.key_path'],
+            cmd,
+            timeout=timeout)
+
+    @journaled('revert')
     def revert(self, args):
         """
             * write a lock file
@@ -523,9 +1413,10 @@ class Sartoris(object):
             tag = args.tag
         else:
             # revert to previous to current tag
-            repo_tags = self._dulwich_get_tags()
+            repo_tags = [entry[2] for entry in
+                         islice(self._iter_tag_entries(), 2)]
             if len(repo_tags) >= 2:
-                tag = repo_tags.keys()[-2]
+                tag = repo_tags[1]
             else:
                 raise SartorisError(message=exit_codes[36], exit_code=36)
 
@@ -536,27 +1427,25 @@ class Sartoris(object):
         #
         # Rollback to tag:
         #
-        #   1. get a commit list
-        #   2. perform no-commit reverts
-        #   3. commit
+        #   1. resolve the commit of the tag
+        #   2. check out the tree of that commit over the working tree
+        #   3. commit it on top of HEAD
         #
 
         log.info(__name__ + ' :: revert - Attempting to revert to tag: {0}'.
                  format(tag))
 
-        tag_commit_sha = self._get_commit_sha_for_tag(tag)
-        commit_sha = None
-        for commit_sha in self._git_commit_list():
-            if commit_sha == tag_commit_sha:
-                break
-            self._git_revert(commit_sha)
-
-        # Ensure the commit tag was matched
-        if commit_sha != tag_commit_sha or not commit_sha:
-            self._dulwich_reset_to_tag()
+        try:
+            tag_commit_sha = self._get_commit_sha_for_tag(tag)
+        except SartorisError:
             raise SartorisError(message=exit_codes[35], exit_code=35)
-        self._dulwich_commit(self._make_author(),
-                             message='Rollback to {0}.'.format(tag))
+
+        if not self._dulwich_revert_to_commit(
+                tag_commit_sha, self._make_author(),
+                'Rollback to {0}.'.format(tag),
+                force=getattr(args, 'force', False)):
+            log.info(__name__ + ' :: revert - HEAD already matches tag: '
+                                '"{0}"'.format(tag))
 
         log.info(__name__ + ' :: revert - Reverted to tag: "{0}", '
                             'call "git deploy sync" to persist'.format(tag))
@@ -584,7 +1473,11 @@ class Sartoris(object):
             * display latest deploy tag
         """
         # Get latest "sync" tag - sets self._tag
-        print self._get_latest_deploy_tag()
+        # Only the newest deploy is read
+        tag = self._get_latest_deploy_tag()
+        if tag is None:
+            raise SartorisError(message=exit_codes[11], exit_code=11)
+        print tag
         return 0
 
     def log_deploys(self, args):
@@ -597,21 +1490,35 @@ class Sartoris(object):
         except NameError:
             raise SartorisError(message=exit_codes[10], exit_code=10)
 
-        tags = self._get_deploy_tags()
-
-        if num_tags <= len(tags):
-            tags = tags[:num_tags]
-
-        for tag in tags:
+        # Stop reading the tag index after the requested number of tags
+        for tag in islice(self._iter_deploy_tags(), max(num_tags, 0)):
             print tag
         return 0
 
-    def diff(self, _):
+    def last_deploy(self, args):
+        """
+            * show the last successful deploy, to --host if given
+        """
+        host = getattr(args, 'host', None)
+        refs = self._get_repo().refs
+        # Deploys whose tag has since been deleted are skipped
+        record = self._get_journal().last_deploy(
+            host, lambda tag: 'refs/tags/' + str(tag) in refs)
+        if record is None:
+            raise SartorisError(message=exit_codes[11], exit_code=11)
+
+        print '{0} {1} {2}'.format(
+            record['tag'], record['sha'],
+            datetime.fromtimestamp(record['time']).strftime(
+                '%Y-%m-%d %H:%M:%S'))
+        return 0
+
+    def diff(self, args):
         """
             * show a git diff of the last deploy and it's previous deploy
         """
 
-        tags = self._get_deploy_tags()
+        tags = list(islice(self._iter_deploy_tags(), 2))
 
         # Check the return code & whether at least two sync tags were
         # returned
@@ -622,17 +1529,27 @@ class Sartoris(object):
         sha_1 = self._get_commit_sha_for_tag(tags[0])
         sha_2 = self._get_commit_sha_for_tag(tags[1])
 
-        # Produce the diff
-        # @TODO replace with dulwich
-        proc = subprocess.Popen("git diff {0} {1}".format(sha_2, sha_1).
-                                split(),
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        lines = proc.communicate()[0].split('\n')
+        from diff import iter_patch, iter_stat, iter_name_only, \
+            iter_name_status
+
+        # Stream the diff file by file
+        try:
+            _repo = self._get_repo()
+            old_tree = self._get_object(sha_2).tree
+            new_tree = self._get_object(sha_1).tree
+
+            if getattr(args, 'name_only', False):
+                lines = iter_name_only(_repo.object_store, old_tree, new_tree)
+            elif getattr(args, 'name_status', False):
+                lines = iter_name_status(_repo.object_store, old_tree,
+                                         new_tree)
+            elif getattr(args, 'stat', False):
+                lines = iter_stat(_repo.object_store, old_tree, new_tree)
+            else:
+                lines = iter_patch(_repo.object_store, old_tree, new_tree)
 
-        if not proc.returncode:
             for line in lines:
-                print line
-        else:
+                sys.stdout.write(line)
+        except KeyError:
             raise SartorisError(message=exit_codes[6], exit_code=6)
         return 0
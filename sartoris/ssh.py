@@ -0,0 +1,250 @@
+"""
+SSH connection management for Sartoris.
+
+Remote calls to deploy targets are routed through a pool of authenticated
+transports keyed on (target, user, key).  Each remote command runs on its
+own channel over the pooled transport, avoiding a key exchange and
+authentication round trip per call.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import stat
+import socket
+import threading
+from time import time
+from pipes import quote
+
+import paramiko
+
+from config import log
+
+# Port used when the target does not specify one, e.g. "host:2222"
+DEFAULT_SSH_PORT = 22
+
+# Bytes read from disk and sent per write on SCP channels
+SCP_CHUNK_SIZE = 64 * 1024
+
+
+class SCPError(Exception):
+    """ Raised when the remote end of an SCP transfer reports an error """
+
+
+def split_target(target, port=DEFAULT_SSH_PORT):
+    """
+    Split a target of the form "host[:port]" into a (host, port) tuple.
+    """
+    host, sep, target_port = target.rpartition(':')
+    if sep and target_port.isdigit():
+        return host, int(target_port)
+    return target, int(port)
+
+
+class SSHConnectionPool(object):
+    """
+    Pool of persistent SSH connections.
+
+    Connections are opened lazily, kept alive with keepalive packets, evicted
+    after ``idle_timeout`` seconds without use and transparently re-opened
+    when the underlying transport has dropped.
+
+    There is no reaper thread, idle connections are only evicted by the
+    next call to :meth:`client`, for any target.
+    """
+
+    # Seconds between keepalive packets sent on pooled transports
+    KEEPALIVE_INTERVAL = 30
+
+    # Seconds a connection may sit unused before it is closed
+    IDLE_TIMEOUT = 300
+
+    def __init__(self, keepalive=KEEPALIVE_INTERVAL,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+
+        # Maps (host, port, user, key) -> [SSHClient, last used timestamp]
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, key):
+        host, port, username, key_filename = key
+
+        log.debug('{0} :: Opening SSH connection to {1}@{2}:{3}'.format(
+            __name__, username, host, port))
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host, port=port, username=username,
+                       key_filename=key_filename)
+        client.get_transport().set_keepalive(self.keepalive)
+
+        # Each command is a few small messages, do not hold them back
+        # waiting on the acknowledgement of the previous one
+        sock = client.get_transport().sock
+        if hasattr(sock, 'setsockopt'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return client
+
+    def _evict_idle(self, now):
+        """ Close connections idle for longer than ``idle_timeout`` """
+        for key, (client, last_used) in self._clients.items():
+            if now - last_used > self.idle_timeout:
+                log.debug('{0} :: Evicting idle SSH connection to '
+                          '{1}'.format(__name__, key[0]))
+                del self._clients[key]
+                client.close()
+
+    def client(self, target, username, key_filename, port=DEFAULT_SSH_PORT):
+        """
+        Return a connected ``paramiko.SSHClient`` for the target, reusing
+        a pooled connection when its transport is still active.
+        """
+        host, port = split_target(target, port)
+        key = (host, port, username, key_filename)
+        now = time()
+
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(key)
+
+            if entry:
+                transport = entry[0].get_transport()
+                if transport is not None and transport.is_active():
+                    entry[1] = now
+                    return entry[0]
+
+                log.debug('{0} :: SSH connection to {1} dropped, '
+                          'reconnecting.'.format(__name__, host))
+                del self._clients[key]
+                entry[0].close()
+
+        # Connect outside of the lock so that connections to different
+        # targets are established concurrently
+        client = self._connect(key)
+
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry:
+                # Another thread connected first, keep its connection
+                client.close()
+                entry[1] = now
+                return entry[0]
+            self._clients[key] = [client, now]
+        return client
+
+    def transport(self, target, username, key_filename,
+                  port=DEFAULT_SSH_PORT):
+        """ Return the pooled ``paramiko.Transport`` for the target """
+        return self.client(target, username, key_filename,
+                           port).get_transport()
+
+    def discard(self, target, username, key_filename,
+                port=DEFAULT_SSH_PORT):
+        """ Close and drop the pooled connection for the target """
+        host, port = split_target(target, port)
+        with self._lock:
+            entry = self._clients.pop((host, port, username, key_filename),
+                                      None)
+        if entry:
+            entry[0].close()
+
+    def exec_command(self, target, username, key_filename, cmd,
+                     port=DEFAULT_SSH_PORT, timeout=None):
+        """
+        Run ``cmd`` on a new channel of the pooled connection.  If the
+        channel cannot be opened the connection is re-established once.
+
+        ``timeout`` bounds, in seconds, each read from the remote command.
+        """
+        try:
+            client = self.client(target, username, key_filename, port)
+            stdin, stdout, stderr = client.exec_command(cmd, timeout=timeout)
+        except (paramiko.SSHException, socket.error, EOFError):
+            self.discard(target, username, key_filename, port)
+            client = self.client(target, username, key_filename, port)
+            stdin, stdout, stderr = client.exec_command(cmd, timeout=timeout)
+
+        stdin.close()
+
+        return {
+            'stdout': [line.strip() for line in stdout.readlines()],
+            'stderr': [line.strip() for line in stderr.readlines()],
+            'exit_code': stdout.channel.recv_exit_status(),
+        }
+
+    def close(self):
+        """ Close all pooled connections """
+        with self._lock:
+            clients = [entry[0] for entry in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+
+def _scp_ack(channel):
+    """
+    Read an SCP acknowledgement, a single null byte.  Warnings and errors
+    are followed by a message which is raised as ``SCPError``.
+    """
+    code = channel.recv(1)
+    if code == '\0':
+        return
+    if not code:
+        raise SCPError('SCP channel closed by the remote end.')
+
+    message = []
+    while True:
+        char = channel.recv(1)
+        if not char or char == '\n':
+            break
+        message.append(char)
+    raise SCPError(''.join(message) or 'SCP transfer failed.')
+
+
+def scp_send(transport, files, remote_dir, chunk_size=SCP_CHUNK_SIZE):
+    """
+    Send a batch of files to ``remote_dir`` over a single SCP channel.
+
+    Parameters:
+        transport   - connected ``paramiko.Transport``
+        files       - list of (local path, remote file name) tuples
+        remote_dir  - existing directory on the remote host
+        chunk_size  - bytes read and sent at a time, memory use is bounded
+                      by this rather than the file size
+
+    Returns the number of bytes of file data sent.
+    """
+    sent = 0
+    channel = transport.open_session()
+    try:
+        channel.exec_command('scp -t -d {0}'.format(quote(remote_dir)))
+        _scp_ack(channel)
+
+        for local_path, remote_name in files:
+            st = os.stat(local_path)
+            channel.sendall('C{0:04o} {1} {2}\n'.format(
+                stat.S_IMODE(st.st_mode), st.st_size, remote_name))
+            _scp_ack(channel)
+
+            with open(local_path, 'rb') as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    channel.sendall(chunk)
+                    sent += len(chunk)
+
+            channel.sendall('\0')
+            _scp_ack(channel)
+    finally:
+        channel.close()
+
+    return sent
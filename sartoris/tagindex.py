@@ -0,0 +1,189 @@
+"""
+Persistent index of the ordered tags of a repository.
+
+The index lives in the deploy directory as two files:
+
+    tag-index           one line per tag, oldest first, of the form
+                        "<tag time> <commit time> <commit sha> <tag>"
+    tag-index.state     fingerprint of the refs the index was built from
+
+The fingerprint holds the mtime of refs/tags and of each directory below
+it, and the mtime and size of packed-refs.  Git and dulwich create, move
+and delete loose refs by renaming or unlinking files, which updates the
+mtime of their directory, so tags created or deleted outside of
+git-deploy cause the index to be rebuilt on the next read.  Checking the
+fingerprint costs a stat per directory, not per tag.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import json
+
+from config import log
+from files import reverse_lines, write_atomic
+
+# Bump when the on-disk layout changes to force a rebuild
+INDEX_VERSION = 2
+
+
+def _stat_key(path):
+    """ The [mtime, size] of ``path``, None if it does not exist """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def refs_fingerprint(git_dir, refs_subdir='refs/tags', dirs=None):
+    """
+    Returns the fingerprint of the refs below ``refs_subdir`` and of
+    packed-refs, a dict of path relative to ``git_dir`` -> [mtime, size].
+
+    Only the directories in ``dirs`` are looked at if given, otherwise the
+    directory tree below ``refs_subdir`` is walked to find them.
+    """
+    if dirs is None:
+        dirs = [refs_subdir]
+        for root, subdirs, _ in os.walk(os.path.join(git_dir, refs_subdir)):
+            dirs.extend(os.path.relpath(os.path.join(root, subdir), git_dir)
+                        for subdir in subdirs)
+
+    fingerprint = dict((path, _stat_key(os.path.join(git_dir, path)))
+                       for path in dirs)
+    fingerprint['packed-refs'] = _stat_key(os.path.join(git_dir,
+                                                        'packed-refs'))
+    return fingerprint
+
+
+def _last_line(path, block_size=4096):
+    """ Returns the last non-empty line of the file at ``path`` """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - block_size))
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    return lines[-1] if lines else None
+
+
+class TagIndex(object):
+    """
+    Ordered tag index stored under the deploy directory.  Entries are
+    tuples of (tag time, commit time, tag, commit sha).
+    """
+
+    INDEX_FILE = 'tag-index'
+    STATE_FILE = 'tag-index.state'
+
+    def __init__(self, git_dir, deploy_dir):
+        self.git_dir = git_dir
+        self.index_path = os.path.join(deploy_dir, self.INDEX_FILE)
+        self.state_path = os.path.join(deploy_dir, self.STATE_FILE)
+
+        if not os.path.exists(deploy_dir):
+            os.makedirs(deploy_dir)
+
+    def _read_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_state(self, dirs=None):
+        write_atomic(self.state_path, json.dumps({
+            'version': INDEX_VERSION,
+            'refs': refs_fingerprint(self.git_dir, dirs=dirs),
+        }))
+
+    def _known_dirs(self, state=None):
+        """ The ref directories of the recorded fingerprint """
+        refs = (state or self._read_state() or {}).get('refs')
+        if not isinstance(refs, dict):
+            return None
+        return [path for path in refs if path != 'packed-refs']
+
+    def is_current(self):
+        """ True if the index matches the current state of the tag refs """
+        state = self._read_state()
+        if not state or state.get('version') != INDEX_VERSION:
+            return False
+        dirs = self._known_dirs(state)
+        return dirs is not None and \
+            state['refs'] == refs_fingerprint(self.git_dir, dirs=dirs)
+
+    def invalidate(self):
+        """ Force a rebuild on the next read """
+        try:
+            os.remove(self.state_path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _format(entry):
+        tag_time, commit_time, tag, commit_sha = entry
+        return '{0} {1} {2} {3}\n'.format(tag_time, commit_time, commit_sha,
+                                          tag)
+
+    @staticmethod
+    def _parse(line):
+        tag_time, commit_time, commit_sha, tag = line.rstrip('\n').split(
+            ' ', 3)
+        return int(tag_time), int(commit_time), tag, commit_sha
+
+    def read(self):
+        """
+        Returns the list of entries oldest first or None if the index is
+        missing or stale.
+        """
+        if not self.is_current():
+            return None
+        try:
+            with open(self.index_path) as f:
+                return [self._parse(line) for line in f if line.strip()]
+        except (IOError, ValueError):
+            return None
+
+    def read_newest_first(self):
+        """
+        Returns a lazy iterator over the entries newest first, reading the
+        index from its end, or None if the index is missing or stale.
+        """
+        if not self.is_current() or not os.path.exists(self.index_path):
+            return None
+        return (self._parse(line) for line in reverse_lines(self.index_path))
+
+    def write(self, entries):
+        """ Replace the index with ``entries``, ordered oldest first """
+        write_atomic(self.index_path,
+                     ''.join(self._format(entry) for entry in entries))
+        self._write_state()
+
+    def append(self, entry):
+        """
+        Incrementally add a single new entry.  The index is invalidated
+        rather than updated if the entry would not sort last.
+        """
+        try:
+            last = _last_line(self.index_path)
+        except IOError:
+            self.invalidate()
+            return
+
+        if last and self._parse(last) > entry:
+            log.debug('{0} :: Tag {1} is out of order, invalidating '
+                      'the tag index.'.format(__name__, entry[2]))
+            self.invalidate()
+            return
+
+        with open(self.index_path, 'a') as f:
+            f.write(self._format(entry))
+
+        # A tag in a new directory needs the tree walked to track it
+        self._write_state(None if '/' in entry[2] else self._known_dirs())
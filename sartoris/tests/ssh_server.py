@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+    sartoris.tests.ssh_server
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    An in-process SSH server standing in for a deploy target.
+
+    Commands are run by the local shell in a sandbox directory, as they
+    would be over SSH on a real target, so the lock helpers, the target
+    hooks and SCP can be exercised and timed without a live host.  Any
+    user and key is accepted.
+
+    The network can be shaped: ``latency`` seconds are added to every
+    round trip, once when a connection or command is opened and once for
+    every response that follows input from the client, and ``bandwidth``
+    caps the bytes per second in each direction.  Failures are injected
+    per command with :meth:`SSHStandIn.fail`.
+
+    :copyright: (c) 2013 by Wikimedia Foundation.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import socket
+import threading
+from time import sleep
+from subprocess import Popen, PIPE
+
+import paramiko
+
+# Failure modes, besides an integer exit status returned without running
+# the command
+REFUSE = 'refuse'   # reject the exec request
+DROP = 'drop'       # drop the connection once the command is received
+
+CHUNK_SIZE = 32 * 1024
+
+# The reply to an exec request is sent by paramiko after the request has
+# been accepted, commands wait this long so that it goes out before any
+# exit status
+REPLY_GRACE = 0.01
+
+
+class _Server(paramiko.ServerInterface):
+    """ Accepts any user and key and hands exec requests to the harness """
+
+    def __init__(self, harness):
+        self.harness = harness
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        failure = self.harness._take_failure(command)
+        self.harness.commands.append(command)
+        if failure == REFUSE:
+            return False
+
+        # Never block the transport thread
+        thread = threading.Thread(target=self.harness._run,
+                                  args=(channel, command, failure))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class SSHStandIn(object):
+    """
+    SSH server on a local port running commands in ``sandbox``.
+
+    Use as::
+
+        server = SSHStandIn(sandbox, latency=0.05).start()
+        ... connect to server.target ...
+        server.stop()
+
+    ``commands`` records every command received and ``connections`` the
+    number of connections accepted.
+    """
+
+    def __init__(self, sandbox, latency=0, bandwidth=None):
+        self.sandbox = sandbox
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        self.commands = []
+        self.connections = 0
+
+        self._failures = []
+        self._lock = threading.Lock()
+        self._transports = []
+        self._socket = None
+        self._host_key = paramiko.RSAKey.generate(1024)
+
+    @property
+    def target(self):
+        """ The target to connect to, "host:port" """
+        return '{0}:{1}'.format(*self._socket.getsockname())
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(16)
+
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+
+    def drop_connections(self):
+        """ Close every open connection, as a restarted target would """
+        for transport in self._transports:
+            transport.close()
+
+    def fail(self, mode, match='', count=1):
+        """
+        Fail the next ``count`` commands containing ``match`` with
+        ``mode``: REFUSE, DROP or an exit status.
+        """
+        with self._lock:
+            self._failures.append([match, mode, count])
+
+    def _take_failure(self, command):
+        with self._lock:
+            for failure in self._failures:
+                match, mode, count = failure
+                if match in command:
+                    if count <= 1:
+                        self._failures.remove(failure)
+                    else:
+                        failure[2] -= 1
+                    return mode
+        return None
+
+    def _delay(self, size=0):
+        """ Sleep for a round trip, or for ``size`` bytes on the wire """
+        if size and self.bandwidth:
+            sleep(float(size) / self.bandwidth)
+        elif not size and self.latency:
+            sleep(self.latency)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._socket.accept()
+            except socket.error:
+                return
+
+            # Small SSH messages must not wait on delayed acknowledgements
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            self._delay()
+            self.connections += 1
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self._host_key)
+            self._transports.append(transport)
+            try:
+                transport.start_server(server=_Server(self))
+            except (paramiko.SSHException, EOFError):
+                transport.close()
+
+    def _run(self, channel, command, failure):
+        """ Run ``command`` in the sandbox, relaying its stdio """
+        sleep(REPLY_GRACE)
+        self._delay()
+
+        if failure == DROP:
+            channel.get_transport().close()
+            return
+        if failure is not None:
+            channel.send_exit_status(failure)
+            channel.close()
+            return
+
+        # The client runs in this process, a command holding on to its
+        # sockets would keep dropped connections open
+        proc = Popen(command, shell=True, cwd=self.sandbox, stdin=PIPE,
+                     stdout=PIPE, stderr=PIPE, close_fds=True)
+
+        # Set while input from the client awaits a response
+        awaiting = threading.Event()
+
+        def pump_input():
+            try:
+                while True:
+                    data = channel.recv(CHUNK_SIZE)
+                    if not data:
+                        break
+                    self._delay(len(data))
+                    awaiting.set()
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            except (IOError, socket.error, EOFError):
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except IOError:
+                    pass
+
+        def pump_output(stream, send):
+            while True:
+                data = os.read(stream.fileno(), CHUNK_SIZE)
+                if not data:
+                    break
+                if awaiting.is_set():
+                    awaiting.clear()
+                    self._delay()
+                self._delay(len(data))
+                try:
+                    send(data)
+                except (socket.error, EOFError):
+                    # The client is gone, as sshd would stop the command
+                    try:
+                        proc.kill()
+                    except OSError:
+                        pass
+                    break
+
+        threads = [threading.Thread(target=pump_output,
+                                    args=(proc.stdout, channel.sendall)),
+                   threading.Thread(target=pump_output,
+                                    args=(proc.stderr,
+                                          channel.sendall_stderr))]
+        stdin_thread = threading.Thread(target=pump_input)
+        stdin_thread.daemon = True
+        stdin_thread.start()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # A command killed by a signal exits as the shell reports it
+        status = proc.wait()
+        channel.send_exit_status(status if status >= 0 else 128 - status)
+        channel.close()
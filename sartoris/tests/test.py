@@ -8,16 +8,46 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import os
+import stat
+import json
+import shlex
 import unittest
+import threading
+from itertools import islice
+from argparse import Namespace
 from collections import namedtuple
-from sartoris.config import log
-from sartoris.sartoris import Sartoris, SartorisError, exit_codes
+from sartoris.config import log, PROFILE_DIR, PROFILE_RATE_ENV
+from sartoris.sartoris import Sartoris, SartorisError, exit_codes, \
+    run_command
+from sartoris.ssh import split_target, scp_send, SCPError, \
+    SSHConnectionPool
+from sartoris.fanout import run_on_hosts, failed_hosts, assign_sources, \
+    TIMED_OUT_EXIT_CODE
+from sartoris.waves import plan_waves, parse_count, parse_rate
+from sartoris.tracing import Tracer, summarize as summarize_spans
+from sartoris.profiling import sampled, start_profile, finish_profile
+from sartoris.diff import iter_patch, iter_stat, iter_name_only, \
+    iter_name_status, ObjectSizes
+from sartoris import lock
+from sartoris.files import reverse_lines
+from sartoris.journal import Journal, make_record, phase_durations
+from sartoris import daemon
+from ssh_server import SSHStandIn, REFUSE, DROP
+import paramiko
 from dulwich.repo import Repo
-from os import mkdir, chdir
-from os.path import exists
+from dulwich.objects import Tag, Commit
+from os import mkdir, makedirs, chdir, chmod, remove
+from os.path import exists, join
 from shutil import rmtree
+from tempfile import mkdtemp
+from subprocess import Popen, PIPE
+from time import time, sleep
+from StringIO import StringIO
 
-from sartoris.config import configure
+from sartoris.config import configure, get_targets, find_top_dir, \
+    load_config_snapshot, save_config_snapshot
+from dulwich.config import ConfigDict
 
 
 # Create the initial singleton
@@ -41,6 +71,40 @@ def setup_deco(test_method):
     return setup_wrap
 
 
+def tmp_repo_deco(test_method):
+    """
+    Like ``setup_deco`` but also points the Sartoris instance at the test
+    repo for the duration of the test.
+    """
+    def tmp_repo_wrap(self):
+        s = Sartoris()
+        top_dir = s.config['top_dir']
+        s.config['top_dir'] = config['deploy.test_repo']
+        try:
+            test_method(self)
+        finally:
+            s.config['top_dir'] = top_dir
+    tmp_repo_wrap.__name__ = test_method.__name__
+    return setup_deco(tmp_repo_wrap)
+
+
+def make_commits(repo, count, timestamp=1380000000):
+    """
+    Write ``count`` commits to the test repo one second apart, returns the
+    list of commit shas oldest first.
+    """
+    shas = []
+    for i in xrange(count):
+        with open(join(repo.path, 'file.txt'), 'w') as f:
+            f.write('revision {0}\n'.format(i))
+        repo.stage(['file.txt'])
+        shas.append(repo.do_commit('commit {0}'.format(i),
+                                   committer='Test <test@example.com>',
+                                   commit_timestamp=timestamp + i,
+                                   commit_timezone=0))
+    return shas
+
+
 def init_tmp_repo():
     """
     Create a test repo, change to directory
@@ -90,6 +154,821 @@ class TestSartorisInit(unittest.TestCase):
         s2 = Sartoris()
         assert s1 == s2
 
+    @setup_deco
+    def test_find_top_dir(self):
+        mkdir(join(config['deploy.test_repo'], 'sub'))
+        assert find_top_dir(join(config['deploy.test_repo'], 'sub')) == \
+            config['deploy.test_repo'].rstrip('/')
+
+    @setup_deco
+    def test_config_snapshot(self):
+        path = join(config['deploy.test_repo'], '.git', 'deploy', 'snapshot')
+        sources = [['/tmp/gitconfig', 1380000000.5, 10]]
+        values = {'target': 'host', 'targets': ['host']}
+
+        assert load_config_snapshot(path, sources) is None
+        save_config_snapshot(path, sources, values)
+        assert load_config_snapshot(path, sources) == values
+        assert load_config_snapshot(
+            path, [['/tmp/gitconfig', 1380000001.0, 10]]) is None
+
+
+class TestSSHConnectionPool(unittest.TestCase):
+    """ Test cases for pooled SSH connections """
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.server = SSHStandIn(self.tmp_dir).start()
+        self.key_path = join(self.tmp_dir, 'id_rsa')
+        paramiko.RSAKey.generate(1024).write_private_key_file(self.key_path)
+        self.pool = SSHConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+        rmtree(self.tmp_dir)
+
+    def client(self):
+        return self.pool.client(self.server.target, 'tester', self.key_path)
+
+    def test_reuse(self):
+        client = self.client()
+        assert self.client() is client
+        ret = self.pool.exec_command(self.server.target, 'tester',
+                                     self.key_path, 'echo hi')
+        assert ret['stdout'] == ['hi'] and ret['exit_code'] == 0
+        assert self.server.connections == 1
+
+    def test_idle_eviction(self):
+        client = self.client()
+        self.pool.idle_timeout = 0.05
+        sleep(0.1)
+
+        # Evicted by the next call to client, not before
+        assert client.get_transport().is_active()
+        assert self.client() is not client
+        assert not client.get_transport()
+        assert self.server.connections == 2
+
+    def test_reconnect_after_drop(self):
+        client = self.client()
+        self.server.drop_connections()
+        while client.get_transport().is_active():
+            sleep(0.01)
+
+        assert self.client() is not client
+        ret = self.pool.exec_command(self.server.target, 'tester',
+                                     self.key_path, 'echo hi')
+        assert ret['stdout'] == ['hi']
+        assert self.server.connections == 2
+
+    def test_split_target_default_port(self):
+        assert split_target('target.realm.org') == ('target.realm.org', 22)
+
+    def test_split_target_with_port(self):
+        assert split_target('target.realm.org:2222') == \
+            ('target.realm.org', 2222)
+
+    def test_singleton_shares_pool(self):
+        assert Sartoris()._get_ssh_pool() is Sartoris()._get_ssh_pool()
+
+
+class TestSSHStandIn(unittest.TestCase):
+    """ Test cases for the remote paths against a local SSH server """
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.sandbox = join(self.tmp_dir, 'target')
+        mkdir(self.sandbox)
+        self.server = SSHStandIn(self.sandbox).start()
+
+        key_path = join(self.tmp_dir, 'id_rsa')
+        paramiko.RSAKey.generate(1024).write_private_key_file(key_path)
+
+        self.s = Sartoris()
+        self.saved = dict(self.s.config)
+        self.s.config.update(target=self.server.target,
+                             targets=[self.server.target],
+                             path=self.sandbox + '/')
+        self.s.config['deploy.key_path'] = key_path
+        self.s._ssh_pool = None
+
+    def tearDown(self):
+        self.s._get_ssh_pool().close()
+        self.s._ssh_pool = None
+        self.s.config.clear()
+        self.s.config.update(self.saved)
+        self.server.stop()
+        rmtree(self.tmp_dir)
+
+    def test_exec_command(self):
+        ret = self.s.ssh_command_target('pwd; echo oops >&2; exit 3')
+        assert ret == {'stdout': [self.sandbox], 'stderr': ['oops'],
+                       'exit_code': 3}
+        assert self.s.ssh_command_target('true')['exit_code'] == 0
+        assert self.server.connections == 1
+
+    def test_lock_round_trips(self):
+        mkdir(join(self.sandbox, '.git'))
+        mkdir(join(self.sandbox, '.git', 'deploy'))
+
+        assert self.s._acquire_lock()[0]
+        assert self.s._check_lock()
+        self.s._remove_lock()
+        assert not self.s._check_lock()
+        assert len(self.server.commands) == 4
+
+    def test_pull_targets(self):
+        hook_dir = join(self.sandbox, self.s.config['hook_dir'])
+        makedirs(hook_dir)
+        hook = join(hook_dir, 'default-target-pull.py')
+        with open(hook, 'w') as f:
+            f.write('#!/bin/sh\necho "$@"\n')
+        chmod(hook, 0755)
+
+        results = self.s._pull_targets('tag')
+        assert results[self.server.target]['stdout'] == [
+            '{0} {1} tag'.format(self.s.config['remote'],
+                                 self.s.config['branch'])]
+
+    def test_scp_files(self):
+        mkdir(join(self.sandbox, 'dir'))
+        files = []
+        for name in ('a', 'b'):
+            with open(join(self.tmp_dir, name), 'w') as f:
+                f.write(name * 100000)
+            files.append((join(self.tmp_dir, name),
+                          join(self.sandbox, 'dir', name)))
+
+        assert self.s.scp_files(files) == 200000
+        assert len(self.server.commands) == 1
+        with open(join(self.sandbox, 'dir', 'b')) as f:
+            assert f.read() == 'b' * 100000
+
+    def test_failure_injection(self):
+        self.server.fail(7, match='echo')
+        assert self.s.ssh_command_target('echo hi')['exit_code'] == 7
+
+        # A dropped connection fails the command, the next one reconnects
+        self.server.fail(DROP, match='echo')
+        assert self.s.ssh_command_target('echo hi')['stdout'] == []
+        assert self.s.ssh_command_target('echo hi')['stdout'] == ['hi']
+        assert self.server.connections == 2
+
+        # A refused channel is retried once on a new connection
+        self.server.fail(REFUSE, match='echo')
+        assert self.s.ssh_command_target('echo hi')['stdout'] == ['hi']
+        assert self.server.connections == 3
+
+    def test_target_timeout(self):
+        # A target trickling output is failed once its deadline passes
+        self.s.config.update(target_timeout=0.5)
+        start = time()
+        results = self.s._run_on_targets(
+            lambda host: self.s.ssh_command_target(
+                'while true; do echo .; sleep 0.1; done', target=host),
+            [self.server.target])
+        assert time() - start < 2
+        assert results[self.server.target]['exit_code'] == \
+            TIMED_OUT_EXIT_CODE
+
+        # Its connection was closed, the next command reconnects
+        assert self.s.ssh_command_target('true')['exit_code'] == 0
+        assert self.server.connections == 2
+
+    def test_network_shaping(self):
+        self.s.ssh_command_target('true')
+        self.server.latency = 0.2
+        start = time()
+        self.s.ssh_command_target('true')
+        assert time() - start >= 0.2
+
+        self.server.latency = 0
+        self.server.bandwidth = 1000000
+        with open(join(self.tmp_dir, 'a'), 'w') as f:
+            f.write('a' * 500000)
+        start = time()
+        self.s.scp_files([(join(self.tmp_dir, 'a'),
+                           join(self.sandbox, 'a'))])
+        assert time() - start >= 0.5
+
+
+class FakeSCPChannel(object):
+    """ Records what is sent and replays canned acknowledgements """
+    def __init__(self, replies):
+        self.replies = replies
+        self.command = None
+        self.sent = []
+
+    def exec_command(self, command):
+        self.command = command
+
+    def recv(self, size):
+        reply, self.replies = self.replies[:size], self.replies[size:]
+        return reply
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+
+class FakeTransport(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def open_session(self):
+        return self.channel
+
+
+class TestSCP(unittest.TestCase):
+    """ Test cases for streaming SCP """
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.path = join(self.tmp_dir, 'artifact')
+        with open(self.path, 'wb') as f:
+            f.write('x' * 10)
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_scp_send_chunks(self):
+        channel = FakeSCPChannel('\0' * 7)
+        sent = scp_send(FakeTransport(channel),
+                        [(self.path, 'a'), (self.path, 'b')],
+                        '/srv/deploy', chunk_size=4)
+        assert sent == 20
+        assert channel.command == 'scp -t -d /srv/deploy'
+        assert channel.sent[0].startswith('C0') and \
+            channel.sent[0].endswith(' 10 a\n')
+        assert channel.sent[1:4] == ['xxxx', 'xxxx', 'xx']
+        assert channel.sent[4] == '\0'
+
+    def test_scp_send_error(self):
+        channel = FakeSCPChannel('\0\x01scp: /srv/deploy/a: denied\n')
+        try:
+            scp_send(FakeTransport(channel), [(self.path, 'a')],
+                     '/srv/deploy')
+        except SCPError as e:
+            assert str(e) == 'scp: /srv/deploy/a: denied'
+            return
+        assert False
+
+
+class TestTargetFanout(unittest.TestCase):
+    """ Test cases for multi-target expansion and concurrent sync """
+    def test_get_targets_list(self):
+        assert get_targets(ConfigDict(), 'a, b c,a') == ['a', 'b', 'c']
+
+    def test_get_targets_group(self):
+        sc = ConfigDict()
+        sc.set(('deploy-group', 'web'), 'hosts', 'web1 web2')
+        assert get_targets(sc, '@web db1') == ['web1', 'web2', 'db1']
+
+    def test_run_on_hosts(self):
+        def call(host):
+            if host == 'bad':
+                raise Exception('unreachable')
+            return {'stdout': [host], 'stderr': []}
+
+        results = run_on_hosts(call, ['a', 'bad', 'b'], 2)
+        assert results.keys() == ['a', 'bad', 'b']
+        assert results['a']['stdout'] == ['a']
+        assert 'elapsed' in results['b']
+        assert failed_hosts(results) == ['bad']
+
+    def test_run_on_hosts_timeout(self):
+        abandoned = []
+
+        def call(host):
+            # The slow host keeps going well past its deadline
+            sleep(2 if host == 'slow' else 0)
+            return {'stdout': [host], 'stderr': []}
+
+        start = time()
+        results = run_on_hosts(call, ['slow', 'a', 'b'], 2, timeout=0.2,
+                               on_timeout=abandoned.append)
+        assert time() - start < 1
+        assert results['slow']['exit_code'] == TIMED_OUT_EXIT_CODE
+        assert failed_hosts(results) == ['slow'] and abandoned == ['slow']
+
+    def test_assign_sources(self):
+        assert assign_sources(['a', 'b'], [], 0) == [('a', None),
+                                                     ('b', None)]
+        assert assign_sources(['c', 'd', 'e', 'f', 'g'], ['a', 'b'], 1) == \
+            [('c', None), ('d', 'a'), ('e', 'b'), ('f', None), ('g', None)]
+
+    @tmp_repo_deco
+    def test_pull_targets_relay(self):
+        s = Sartoris()
+        pulled = []
+
+        def ssh_command_target(cmd, target=None, timeout=None):
+            pulled.append((target, shlex.split(cmd)[1]))
+            return {'stdout': [], 'stderr': [],
+                    'exit_code': 1 if target == 'h2' else 0}
+
+        saved = dict(s.config)
+        s.config.update(targets=['h1', 'h2', 'h3', 'h4', 'h5', 'h6'],
+                        relay_fanout=1, remote='origin', user='deployer')
+        s.ssh_command_target = ssh_command_target
+        try:
+            results = s._pull_targets('tag')
+        finally:
+            del s.ssh_command_target
+            s.config.clear()
+            s.config.update(saved)
+
+        assert results.keys() == ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']
+        url = 'ssh://deployer@h1:22{0}'.format(saved['path'])
+        # Waves of 1, 2 and 3 hosts, the failed h2 never relays
+        assert pulled[0] == ('h1', 'origin')
+        assert results['h2']['source'] == 'origin'
+        assert results['h3']['source'] == 'h1' and ('h3', url) in pulled
+        assert [results[h]['source'] for h in ('h4', 'h5', 'h6')] == \
+            ['origin', 'h1', 'h3']
+
+    @tmp_repo_deco
+    def test_ssh_user(self):
+        """ Commands on targets and relay URLs use the same login """
+        s = Sartoris()
+        logins = []
+
+        class Pool(object):
+            def exec_command(self, host, user, key_path, cmd, timeout=None):
+                logins.append(user)
+
+        pool, s._ssh_pool = s._ssh_pool, Pool()
+        try:
+            s.ssh_command_target('true', target='h1')
+        finally:
+            s._ssh_pool = pool
+        assert logins == [s.config['user']]
+        assert s._relay_url('h1').startswith(
+            'ssh://{0}@h1:'.format(s.config['user']))
+
+
+class TestRollingWaves(unittest.TestCase):
+    """ Test cases for canary and rolling wave deploys """
+    def test_parse_count(self):
+        assert parse_count('10%', 25) == 3
+        assert parse_count('0%', 25) == 0
+        assert parse_count(4, 25) == 4
+        assert parse_rate('5%') == 0.05 and parse_rate('0.2') == 0.2
+
+    def test_plan_waves(self):
+        hosts = ['h{0}'.format(i) for i in xrange(7)]
+        assert plan_waves(hosts, 0, 0) == [hosts]
+        assert plan_waves(hosts, 1, '50%') == \
+            [['h0'], ['h1', 'h2', 'h3', 'h4'], ['h5', 'h6']]
+
+    def roll_out(self, failing, **settings):
+        """
+        Roll out to six hosts with a stubbed SSH command, ``failing`` maps
+        the hosts to the commands failing on them.  Returns the results
+        and the (host, command) calls made.
+        """
+        s = Sartoris()
+        calls = []
+
+        def ssh_command_target(cmd, target=None, timeout=None):
+            calls.append((target, cmd))
+            fails = any(word in cmd for word in failing.get(target, []))
+            return {'stdout': [], 'stderr': [], 'exit_code': int(fails)}
+
+        saved = dict(s.config)
+        s._tracer.reset()
+        s.config.update(targets=['h{0}'.format(i) for i in xrange(6)],
+                        relay_fanout=0, ship_pack=False, wave_pause=0,
+                        health_check=None, canary=1, wave_size=2,
+                        max_failure_rate='25%')
+        s.config.update(settings)
+        s.ssh_command_target = ssh_command_target
+        try:
+            return s._roll_out('tag'), calls
+        finally:
+            del s.ssh_command_target
+            s.config.clear()
+            s.config.update(saved)
+
+    def test_roll_out_waves(self):
+        results, calls = self.roll_out({'h3': ['pull']},
+                                       max_failure_rate='50%')
+        assert results.keys() == ['h0', 'h1', 'h2', 'h3', 'h4', 'h5']
+        assert [host for host, _ in calls] == results.keys()
+        assert results['h3']['exit_code'] == 1
+
+        spans = Sartoris()._tracer.spans
+        assert sorted(span['host'] for span in spans) == results.keys()
+        assert [span['outcome'] for span in spans
+                if span['host'] == 'h3'] == ['error']
+
+    def test_roll_out_halts(self):
+        # Half of the second wave fails, the last wave is skipped
+        results, _ = self.roll_out({'h1': ['pull']})
+        assert results.keys() == ['h0', 'h1', 'h2']
+
+        # A failing canary health check stops the deploy
+        results, calls = self.roll_out({'h0': ['healthy']},
+                                       health_check='./healthy')
+        assert results.keys() == ['h0']
+        assert results['h0']['exit_code'] == 1
+        assert calls[-1] == ('h0', 'cd {0} && ./healthy'.format(
+            config['deploy.test_repo']))
+
+
+class TestTracing(unittest.TestCase):
+    """ Test cases for the timing spans of commands """
+    def setUp(self):
+        self.trace_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.trace_dir)
+
+    def test_span_outcome(self):
+        tracer = Tracer()
+        with tracer.span('ok', host='h1'):
+            pass
+        try:
+            with tracer.span('fails'):
+                raise SartorisError(message='boom', exit_code=1)
+        except SartorisError:
+            pass
+
+        ok, fails = tracer.spans
+        assert ok['outcome'] == 'ok' and ok['host'] == 'h1'
+        assert fails['outcome'] == 'error' and fails['error'] == 'boom'
+        assert ok['duration'] >= 0
+
+    def test_write_threads(self):
+        tracer = Tracer()
+        run_on_hosts(lambda host: tracer.add('pull', time(), 0.5, host=host),
+                     ['h{0}'.format(i) for i in xrange(50)], 10)
+
+        path = join(self.trace_dir, 'deploy', 'trace.jsonl')
+        tracer.write(path, 'sync')
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        assert len(records) == 50
+        assert set(r['trace'] for r in records) == set([tracer.trace_id])
+        assert all(r['command'] == 'sync' for r in records)
+
+        lines = summarize_spans(tracer.spans)
+        assert len(lines) == 52 and lines[-1].startswith('total')
+
+    def test_write_compacts(self):
+        tracer = Tracer()
+        path = join(self.trace_dir, 'trace.jsonl')
+        trace_ids = []
+        for _ in xrange(20):
+            trace_ids.append(tracer.trace_id)
+            tracer.add('tag', time(), 0.1)
+            tracer.add('push', time(), 0.2)
+            tracer.write(path, 'sync', max_size=2048, keep=3)
+            tracer.reset()
+
+        with open(path) as f:
+            traces = [json.loads(line)['trace'] for line in f]
+        # Whole traces are kept, oldest first
+        kept = traces[::2]
+        assert traces[1::2] == kept
+        assert 3 <= len(kept) < 20 and kept == trace_ids[-len(kept):]
+
+
+class TestProfiling(unittest.TestCase):
+    """ Test cases for profiling of commands """
+    def setUp(self):
+        self.profile_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.profile_dir)
+
+    def test_sampled(self):
+        assert sampled('100%') and sampled('1')
+        assert not sampled(None) and not sampled('0') and not sampled('x')
+
+    def test_finish_profile(self):
+        out = StringIO()
+        path = join(self.profile_dir, 'profiles', 'sync-tag.prof')
+        profiler = start_profile()
+        sorted(xrange(1000), reverse=True)
+        finish_profile(profiler, path, top=5, stream=out)
+
+        assert exists(path)
+        assert 'Ordered by: cumulative time' in out.getvalue()
+
+
+class TestJournal(unittest.TestCase):
+    """ Test cases for the deploy journal """
+    def setUp(self):
+        self.journal_dir = mkdtemp()
+        self.journal = Journal(join(self.journal_dir, 'deploy', 'journal'))
+
+    def tearDown(self):
+        rmtree(self.journal_dir)
+
+    def deploy(self, tag, targets, action='sync', outcome='ok'):
+        self.journal.append(make_record(action=action, tag=tag, sha='0' * 40,
+                                        targets=targets, outcome=outcome,
+                                        time=time()))
+
+    def test_read_newest_first(self):
+        self.deploy('t1', {'h1': 'ok'})
+        self.deploy('t2', {'h1': 'ok'}, outcome='error')
+        with open(self.journal.path, 'a') as f:
+            f.write('{"action": "sync", "tag"')
+
+        records = list(self.journal.read_newest_first())
+        assert [r['tag'] for r in records] == ['t2', 't1']
+        assert sorted(records[0].keys()) == sorted(make_record().keys())
+
+    def test_last_deploy(self):
+        assert self.journal.last_deploy() is None
+        self.deploy('t1', {'h1': 'ok', 'h2': 'ok'})
+        self.deploy('t2', {'h1': 'ok', 'h2': 'error'})
+        self.deploy(None, {}, action='abort')
+
+        assert self.journal.last_deploy()['tag'] == 't2'
+        assert self.journal.last_deploy('h2')['tag'] == 't1'
+        assert self.journal.last_deploy('h3') is None
+
+    def test_compact(self):
+        self.journal.keep = 2
+        self.deploy('t1', {'h1': 'ok', 'h2': 'ok'})
+        self.deploy('t2', {'h1': 'ok', 'h2': 'ok'})
+        self.deploy('t3', {'h1': 'ok', 'h2': 'error'})
+        self.deploy('t4', {'h1': 'ok', 'h2': 'error'})
+        self.deploy('t5', {'h1': 'ok', 'h2': 'error'})
+        self.journal.compact()
+
+        assert [r['tag'] for r in self.journal.read_newest_first()] == \
+            ['t5', 't4', 't2']
+        assert self.journal.last_deploy('h2')['tag'] == 't2'
+
+    def test_phase_durations(self):
+        spans = [{'name': 'tag', 'start': 10.0, 'duration': 0.5},
+                 {'name': 'target_pull', 'start': 11.0, 'duration': 2.0},
+                 {'name': 'target_pull', 'start': 11.5, 'duration': 2.0}]
+        assert phase_durations(spans) == {'tag': 0.5, 'target_pull': 2.5}
+
+
+class TestDaemon(unittest.TestCase):
+    """ Test cases for commands served by the git-deploy daemon """
+    def setUp(self):
+        self.socket_dir = mkdtemp()
+        self.path = join(self.socket_dir, 'daemon.sock')
+        self.server = threading.Thread(target=daemon.serve,
+                                       args=(self.path, 10))
+        self.server.daemon = True
+        self.server.start()
+        while not daemon.is_running(self.path):
+            sleep(0.01)
+
+    def tearDown(self):
+        daemon.shutdown(self.path)
+        self.server.join()
+        # The socket goes with the daemon
+        assert not exists(self.path)
+        rmtree(self.socket_dir)
+
+    def request(self, method):
+        args = Namespace(method=method, verbose=0, quiet=0, silent=False,
+                         profile=False, profile_top=20, trace=False)
+        out, err = StringIO(), StringIO()
+        return daemon.request(self.path, args, out, err), out, err
+
+    def test_request(self):
+        s = Sartoris()
+
+        def echo(args):
+            print 'echo {0}'.format(args.method)
+
+        def fail(args):
+            raise SartorisError(message=exit_codes[30], exit_code=30)
+
+        s.echo, s.fail = echo, fail
+        try:
+            exit_code, out, err = self.request('echo')
+            assert exit_code is None and out.getvalue() == 'echo echo\n'
+            exit_code, out, err = self.request('fail')
+            assert exit_code == 30 and exit_codes[30] in err.getvalue()
+            exit_code, out, err = self.request('no_such_method')
+            assert exit_codes[60] in err.getvalue()
+        finally:
+            del s.echo, s.fail
+
+    def test_command_output(self):
+        """ Output of the commands run by a method reaches the client """
+        s = Sartoris()
+        s.shell = lambda args: run_command(
+            ['sh', '-c', 'echo out; echo err >&2'])
+        try:
+            exit_code, out, err = self.request('shell')
+            assert out.getvalue() == 'out\nerr\n'
+        finally:
+            del s.shell
+
+    def test_client_gone(self):
+        """ A command runs to the end after its client went away """
+        s = Sartoris()
+        closed = threading.Event()
+        finished = []
+
+        def chatty(args):
+            print 'started'
+            closed.wait(10)
+            for _ in xrange(1000):
+                print 'x' * 1024
+            finished.append(True)
+
+        s.chatty, s.echo = chatty, lambda args: None
+        args = Namespace(method='chatty', verbose=0, quiet=0, silent=False,
+                         profile=False, profile_top=20, trace=False)
+        conn = daemon._connect(self.path)
+        try:
+            daemon._send(conn, {'args': vars(args)})
+            assert json.loads(conn.makefile('r').readline()) == \
+                {'out': 'started'}
+        finally:
+            conn.close()
+            closed.set()
+
+        try:
+            # Requests are served one at a time, after chatty is done
+            assert self.request('echo')[0] is None
+            assert finished
+        finally:
+            del s.chatty, s.echo
+
+    def test_client_env(self):
+        """ The profile sampling rate comes from the client """
+        s = Sartoris()
+        s.echo = lambda args: None
+        s._get_profile_path = lambda method: join(self.socket_dir,
+                                                  method + '.prof')
+        saved = os.environ.pop(PROFILE_RATE_ENV, None)
+        args = Namespace(method='echo', verbose=0, quiet=0, silent=False,
+                         profile=False, profile_top=20, trace=False)
+        conn = daemon._connect(self.path)
+        try:
+            daemon._send(conn, {'args': vars(args),
+                                'env': {PROFILE_RATE_ENV: '100%'}})
+            for line in conn.makefile('r'):
+                if 'exit_code' in json.loads(line):
+                    break
+        finally:
+            conn.close()
+            del s.echo, s._get_profile_path
+            if saved is not None:
+                os.environ[PROFILE_RATE_ENV] = saved
+        assert exists(join(self.socket_dir, 'echo.prof'))
+
+
+def run_shell(cmd):
+    """ Run a command locally as it would be over SSH, returns stdout lines """
+    out = Popen(cmd, shell=True, stdout=PIPE).communicate()[0]
+    return [line.strip() for line in out.splitlines()]
+
+
+class TestRemoteLock(unittest.TestCase):
+    """ Test cases for the single round trip remote lock commands """
+
+    def setUp(self):
+        self.lock_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.lock_dir)
+
+    def test_acquire_exclusive(self):
+        path = join(self.lock_dir, 'lock')
+        mine = lock.format_lock('me', 'client', 1, time(), 60)
+        theirs = lock.format_lock('them', 'other', 2, time(), 60)
+
+        acquired, _ = lock.parse_acquire(
+            run_shell(lock.acquire_command(path, mine)))
+        assert acquired
+
+        acquired, held = lock.parse_acquire(
+            run_shell(lock.acquire_command(path, theirs)))
+        assert not acquired
+        assert held['owner'] == 'me' and held['pid'] == 1
+
+        now, current = lock.parse_read(run_shell(lock.read_command(path)))
+        assert lock.is_held_by(current, 'me', now)
+        assert not lock.is_held_by(current, 'them', now)
+
+    def test_acquire_stale(self):
+        path = join(self.lock_dir, 'lock')
+        stale = lock.format_lock('me', 'client', 1, time() - 120, 60)
+        with open(path, 'w') as f:
+            f.write(stale)
+
+        theirs = lock.format_lock('them', 'other', 2, time(), 60)
+        acquired, _ = lock.parse_acquire(
+            run_shell(lock.acquire_command(path, theirs)))
+        assert acquired
+        with open(path) as f:
+            assert f.read() == theirs
+
+    def test_release_owner_only(self):
+        path = join(self.lock_dir, 'lock')
+        run_shell(lock.acquire_command(
+            path, lock.format_lock('me', 'client', 1, time(), 60)))
+
+        run_shell(lock.release_command(path, 'them'))
+        assert exists(path)
+        run_shell(lock.release_command(path, 'me'))
+        assert not exists(path)
+        assert lock.parse_read(run_shell(lock.read_command(path)))[1] == {}
+
+
+class TestStreamingDiff(unittest.TestCase):
+    """ Test cases for streaming tree diffs """
+
+    @setup_deco
+    def test_diff_output(self):
+        repo = Repo(config['deploy.test_repo'])
+        shas = make_commits(repo, 2)
+        with open(join(repo.path, 'data.bin'), 'wb') as f:
+            f.write('\x00\x01binary')
+        repo.stage(['data.bin'])
+        head = repo.do_commit('add binary', committer='Test <t@example.com>')
+
+        store = repo.object_store
+        old_tree, new_tree = repo[shas[0]].tree, repo[head].tree
+
+        patch = ''.join(iter_patch(store, old_tree, new_tree))
+        assert 'Binary files /dev/null and b/data.bin differ' in patch
+        assert 'new file mode 100644\n' in patch
+        assert '-revision 0\n+revision 1\n' in patch
+
+        # Blobs over the size limit are not diffed
+        patch = ''.join(iter_patch(store, old_tree, new_tree,
+                                   max_blob_size=4))
+        assert 'Binary files a/file.txt and b/file.txt differ' in patch
+
+        assert list(iter_name_only(store, old_tree, new_tree)) == \
+            ['data.bin\n', 'file.txt\n']
+        assert list(iter_name_status(store, old_tree, new_tree)) == \
+            ['A\tdata.bin\n', 'M\tfile.txt\n', ' 2 file(s) changed\n']
+        assert list(iter_stat(store, old_tree, new_tree)) == \
+            [' data.bin | Bin 0 -> 8 bytes\n', ' file.txt | 2 +-\n',
+             ' 2 files changed, 1 insertion(+), 1 deletion(-)\n']
+
+    @setup_deco
+    def test_diff_applies(self):
+        """ Patches apply with git, files without a last newline included """
+        repo = Repo(config['deploy.test_repo'])
+        author = 'Test <t@example.com>'
+        contents = [{'tail.txt': 'a\nb', 'context.txt': 'x\ny\nz'},
+                    {'tail.txt': 'a\nc', 'context.txt': 'X\ny\nz',
+                     'empty.txt': '', 'new.txt': 'new'}]
+        trees = []
+        for files in contents:
+            for path, data in files.iteritems():
+                with open(join(repo.path, path), 'w') as f:
+                    f.write(data)
+            repo.stage(files.keys())
+            trees.append(repo[repo.do_commit('c', committer=author)].tree)
+
+        patch = ''.join(iter_patch(repo.object_store, *trees))
+        assert '+c\n\\ No newline at end of file\n' in patch
+        assert ' z\n\\ No newline at end of file\n' in patch
+        assert '@@ -0,0 +1,1 @@\n' in patch
+
+        # The working tree is at the new commit, the patch undoes it
+        proc = Popen(['git', 'apply', '-R', '--check', '-'], stdin=PIPE,
+                     stderr=PIPE, cwd=repo.path)
+        assert proc.communicate(patch)[1] == '' and proc.returncode == 0
+
+    @setup_deco
+    def test_blob_size_before_read(self):
+        """ Packed blobs over the size limit are measured but not read """
+        repo = Repo(config['deploy.test_repo'])
+        shas = make_commits(repo, 2)
+        Popen(['git', 'repack', '-a', '-d', '-q'], cwd=repo.path).wait()
+        repo = Repo(config['deploy.test_repo'])
+        store = repo.object_store
+        old_tree, new_tree = repo[shas[0]].tree, repo[shas[1]].tree
+        blob = repo[store[new_tree]['file.txt'][1]]
+
+        sizes = ObjectSizes(store)
+        try:
+            assert sizes(blob.id) == len('revision 1\n')
+        finally:
+            sizes.close()
+
+        get_raw = store.get_raw
+
+        def get_raw_trees(sha):
+            assert sha != blob.id, 'blob read'
+            return get_raw(sha)
+        store.get_raw = get_raw_trees
+        assert 'Binary files a/file.txt and b/file.txt differ\n' in \
+            ''.join(iter_patch(store, old_tree, new_tree, max_blob_size=4))
+        assert list(iter_stat(store, old_tree, new_tree, max_blob_size=4)) \
+            == [' file.txt | Bin 11 -> 11 bytes\n',
+                ' 1 file changed, 0 insertions(+), 0 deletions(-)\n']
+
 
 class TestSartorisFunctionality(unittest.TestCase):
 
@@ -188,6 +1067,26 @@ class TestSartorisFunctionality(unittest.TestCase):
         except SartorisError:
             assert False
 
+    @tmp_repo_deco
+    def test_sync_profile_named_by_tag(self):
+        """ The profile of a sync is named after the tag it synced """
+        s = Sartoris()
+        make_commits(Repo(config['deploy.test_repo']), 1)
+        s._check_lock = lambda: True
+        s._default_sync = lambda tag: {}
+        s._remove_lock = lambda: None
+        args = Namespace(method='sync', force=False, profile=True,
+                         profile_top=0, trace=False)
+        try:
+            assert daemon.dispatch(args, StringIO()) is None
+        finally:
+            del s._check_lock, s._default_sync, s._remove_lock
+
+        path = join(s.config['top_dir'], PROFILE_DIR,
+                    'sync-{0}.prof'.format(s._tag))
+        assert s._tag and exists(path)
+        remove(path)
+
     @setup_deco
     def test_deploy_in_progress(self):
         """
@@ -228,6 +1127,453 @@ class TestSartorisDulwichDeps(unittest.TestCase):
         tags = s._dulwich_get_tags()
         assert tags.keys()[0] == tag
 
+    @tmp_repo_deco
+    def test_dulwich_get_tags_order(self):
+        """
+        Tests method Sartoris::_dulwich_get_tags orders tags newest first
+        by commit time and peels annotated tags to their commit
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        shas = make_commits(repo, 3)
+
+        repo.refs['refs/tags/lightweight'] = shas[1]
+        s._dulwich_tag('annotated', s._make_author())
+        repo.refs['refs/tags/first'] = shas[0]
+
+        tags = s._dulwich_get_tags()
+        assert tags.keys() == ['annotated', 'lightweight', 'first']
+        assert tags['annotated'] == shas[2]
+
+    @tmp_repo_deco
+    def test_deploy_tags_order_by_tag_time(self):
+        """
+        Tests a deploy tag on an older commit, e.g. after a rollback, is
+        the latest deploy
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        shas = make_commits(repo, 2)
+        tags = ['{0}-20130924-00000{1}'.format(config['user'], i)
+                for i in xrange(2)]
+
+        for tag, sha, tag_time in zip(tags, reversed(shas),
+                                      (1390000000, 1390000060)):
+            tag_obj = Tag()
+            tag_obj.tagger = s._make_author()
+            tag_obj.message = 'deploy'
+            tag_obj.name = tag
+            tag_obj.object = (Commit, sha)
+            tag_obj.tag_time = tag_time
+            tag_obj.tag_timezone = 0
+            repo.object_store.add_object(tag_obj)
+            repo.refs['refs/tags/' + tag] = tag_obj.id
+
+        assert s._get_latest_deploy_tag() == tags[1]
+        assert s._get_deploy_tags() == tags[::-1]
+
+    @tmp_repo_deco
+    def test_get_commit_sha_for_tag(self):
+        """
+        Tests method Sartoris::_get_commit_sha_for_tag peels lightweight
+        and annotated tags to their commit
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        shas = make_commits(repo, 2)
+
+        repo.refs['refs/tags/lightweight'] = shas[0]
+        s._dulwich_tag('annotated', s._make_author())
+
+        assert s._get_commit_sha_for_tag('lightweight') == shas[0]
+        assert s._get_commit_sha_for_tag('annotated') == shas[1]
+        self.assertRaises(SartorisError, s._get_commit_sha_for_tag,
+                          'missing')
+
+        # Branches, full refs and sha prefixes resolve as with git rev-list
+        repo.refs['refs/heads/branch'] = shas[0]
+        assert s._get_commit_sha_for_tag('branch') == shas[0]
+        assert s._get_commit_sha_for_tag('refs/heads/branch') == shas[0]
+        assert s._get_commit_sha_for_tag(shas[0][:7]) == shas[0]
+        assert s._get_commit_sha_for_tag(shas[1].upper()) == shas[1]
+        for name in (shas[0][:3], 'zzzzzzz'):
+            self.assertRaises(SartorisError, s._get_commit_sha_for_tag,
+                              name)
+
+    @tmp_repo_deco
+    def test_dulwich_revert_to_commit(self):
+        """
+        Tests method Sartoris::_dulwich_revert_to_commit restores the tree
+        of the target commit in a single commit on top of HEAD
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        shas = make_commits(repo, 3)
+
+        with open(join(repo.path, 'extra.txt'), 'w') as f:
+            f.write('extra\n')
+        repo.stage(['extra.txt'])
+        head = repo.do_commit('add extra', committer='Test <t@example.com>')
+
+        assert s._dulwich_revert_to_commit(shas[0], s._make_author(),
+                                           'Rollback')
+        assert repo[repo.head()].parents == [head]
+        assert repo[repo.head()].tree == repo[shas[0]].tree
+        assert not exists(join(repo.path, 'extra.txt'))
+        with open(join(repo.path, 'file.txt')) as f:
+            assert f.read() == 'revision 0\n'
+        assert s._dulwich_status() == []
+
+    @tmp_repo_deco
+    def test_dulwich_revert_type_changes(self):
+        """
+        Tests Sartoris::_dulwich_revert_to_commit when a directory becomes
+        a file and a file a directory
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        author = 'Test <t@example.com>'
+
+        mkdir(join(repo.path, 'dir'))
+        for path in ('dir/a', 'dir/b', 'file'):
+            with open(join(repo.path, path), 'w') as f:
+                f.write(path)
+        repo.stage(['dir/a', 'dir/b', 'file'])
+        first = repo.do_commit('first', committer=author)
+
+        rmtree(join(repo.path, 'dir'))
+        remove(join(repo.path, 'file'))
+        mkdir(join(repo.path, 'file'))
+        for path in ('dir', 'file/c'):
+            with open(join(repo.path, path), 'w') as f:
+                f.write(path)
+        Popen(['git', 'add', '-A'], cwd=repo.path).wait()
+        second = repo.do_commit('second', committer=author)
+
+        assert s._dulwich_revert_to_commit(first, s._make_author(), 'back')
+        assert repo[repo.head()].tree == repo[first].tree
+        with open(join(repo.path, 'dir', 'a')) as f:
+            assert f.read() == 'dir/a'
+
+        assert s._dulwich_revert_to_commit(second, s._make_author(), 'fwd')
+        with open(join(repo.path, 'file', 'c')) as f:
+            assert f.read() == 'file/c'
+        assert s._dulwich_status() == [] and s._dulwich_unstaged() == []
+
+    @tmp_repo_deco
+    def test_dulwich_revert_refuses_local_changes(self):
+        """
+        Tests Sartoris::_dulwich_revert_to_commit keeps uncommitted changes
+        unless forced
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        shas = make_commits(repo, 2)
+        with open(join(repo.path, 'file.txt'), 'w') as f:
+            f.write('local edit\n')
+
+        try:
+            s._dulwich_revert_to_commit(shas[0], s._make_author(), 'back')
+            assert False
+        except SartorisError as e:
+            assert e.exit_code == 15
+        with open(join(repo.path, 'file.txt')) as f:
+            assert f.read() == 'local edit\n'
+
+        assert s._dulwich_revert_to_commit(shas[0], s._make_author(), 'back',
+                                           force=True)
+        with open(join(repo.path, 'file.txt')) as f:
+            assert f.read() == 'revision 0\n'
+
+    @tmp_repo_deco
+    def test_dulwich_revert_refuses_staged_changes(self):
+        """
+        Tests Sartoris::_dulwich_revert_to_commit keeps changes staged in
+        the index
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        shas = make_commits(repo, 2)
+        with open(join(repo.path, 'file.txt'), 'w') as f:
+            f.write('staged edit\n')
+        repo.stage(['file.txt'])
+
+        try:
+            s._dulwich_revert_to_commit(shas[0], s._make_author(), 'back')
+            assert False
+        except SartorisError as e:
+            assert e.exit_code == 15
+        assert repo.head() == shas[1]
+        with open(join(repo.path, 'file.txt')) as f:
+            assert f.read() == 'staged edit\n'
+
+    @tmp_repo_deco
+    def test_dulwich_revert_refuses_untracked_files(self):
+        """
+        Tests Sartoris::_dulwich_revert_to_commit keeps untracked files the
+        tree would overwrite or whose directory it would replace
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        author = 'Test <t@example.com>'
+
+        for path in ('c.txt', 'd'):
+            with open(join(repo.path, path), 'w') as f:
+                f.write('tracked\n')
+        repo.stage(['c.txt', 'd'])
+        first = repo.do_commit('first', committer=author)
+
+        remove(join(repo.path, 'c.txt'))
+        remove(join(repo.path, 'd'))
+        mkdir(join(repo.path, 'd'))
+        with open(join(repo.path, 'd', 'x'), 'w') as f:
+            f.write('x\n')
+        Popen(['git', 'add', '-A'], cwd=repo.path).wait()
+        second = repo.do_commit('second', committer=author)
+
+        for path in ('c.txt', join('d', 'mine')):
+            with open(join(repo.path, path), 'w') as f:
+                f.write('my untracked work')
+            try:
+                s._dulwich_revert_to_commit(first, s._make_author(), 'back')
+                assert False
+            except SartorisError as e:
+                assert e.exit_code == 15
+            assert repo.head() == second
+            with open(join(repo.path, path)) as f:
+                assert f.read() == 'my untracked work'
+            remove(join(repo.path, path))
+
+        assert s._dulwich_revert_to_commit(first, s._make_author(), 'back')
+        with open(join(repo.path, 'd')) as f:
+            assert f.read() == 'tracked\n'
+
+    @tmp_repo_deco
+    def test_dulwich_stage_all(self):
+        """
+        Tests method Sartoris::_dulwich_stage_all stages new, modified and
+        deleted files but nothing under .git
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        make_commits(repo, 1)
+
+        mkdir(join(repo.path, 'sub'))
+        with open(join(repo.path, 'sub', 'new.txt'), 'w') as f:
+            f.write('new\n')
+        with open(join(repo.path, 'file.txt'), 'w') as f:
+            f.write('modified\n')
+        s._dulwich_stage_all()
+
+        changes = sorted(change.old.path for change in s._dulwich_status())
+        assert changes == ['file.txt', 'sub/new.txt']
+        assert not [path for path in repo.open_index()
+                    if path.startswith('.git')]
+
+        remove(join(repo.path, 'sub', 'new.txt'))
+        s._dulwich_stage_all()
+        assert 'sub/new.txt' not in repo.open_index()
+
+    @tmp_repo_deco
+    def test_dulwich_stage_all_symlinks(self):
+        """
+        Tests method Sartoris::_dulwich_stage_all stages symlinks as links,
+        broken ones included
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        make_commits(repo, 1)
+
+        mkdir(join(repo.path, 'sub'))
+        os.symlink('file.txt', join(repo.path, 'link'))
+        os.symlink('missing', join(repo.path, 'broken'))
+        os.symlink('sub', join(repo.path, 'dir_link'))
+        s._dulwich_stage_all()
+
+        index = repo.open_index()
+        for path, target in (('link', 'file.txt'), ('broken', 'missing'),
+                             ('dir_link', 'sub')):
+            assert stat.S_ISLNK(index[path][4])
+            assert repo[index[path][8]].data == target
+        assert not s._dulwich_unstaged()
+
+    @tmp_repo_deco
+    def test_shared_repo_handle(self):
+        """
+        Tests the repository handle and object cache are shared between
+        operations and reset when packed-refs changes
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        shas = make_commits(repo, 1)
+
+        handle = s._get_repo()
+        assert s._get_repo() is handle
+        assert s._get_object(shas[0]) is s._get_object(shas[0])
+
+        with open(join(repo.controldir(), 'packed-refs'), 'w') as f:
+            f.write('{0} refs/tags/packed\n'.format(shas[0]))
+        assert s._get_repo() is not handle
+        assert s._get_commit_sha_for_tag('packed') == shas[0]
+
+    @tmp_repo_deco
+    def test_tag_index(self):
+        """
+        Tests the tag index is updated incrementally by Sartoris::_dulwich_tag
+        and rebuilt when tags change outside of git-deploy
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        make_commits(repo, 2)
+
+        # Build the index, then tag
+        assert s._dulwich_get_tags().keys() == []
+        s._dulwich_tag('first', s._make_author())
+        assert s._get_tag_index().is_current()
+
+        s._dulwich_tag('second', s._make_author())
+        assert s._get_tag_index().is_current()
+        assert s._dulwich_get_tags().keys() == ['second', 'first']
+
+        del repo.refs['refs/tags/second']
+        assert not s._get_tag_index().is_current()
+        assert s._dulwich_get_tags().keys() == ['first']
+
+    @tmp_repo_deco
+    def test_tag_index_many_loose_tags(self):
+        """
+        Tests checking the tag index costs a stat per ref directory, not
+        per tag, and still notices tags created outside of git-deploy
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        sha = make_commits(repo, 1)[0]
+        for i in xrange(300):
+            repo.refs['refs/tags/tag-{0:03d}'.format(i)] = sha
+        assert len(s._dulwich_get_tags()) == 300
+
+        stats = []
+        stat = os.stat
+
+        def counting_stat(path):
+            stats.append(path)
+            return stat(path)
+
+        os.stat = counting_stat
+        try:
+            assert s._get_tag_index().is_current()
+        finally:
+            os.stat = stat
+        assert len(stats) <= 3
+
+        repo.refs['refs/tags/nested/tag'] = sha
+        assert not s._get_tag_index().is_current()
+        assert len(s._dulwich_get_tags()) == 301
+        del repo.refs['refs/tags/nested/tag']
+        assert not s._get_tag_index().is_current()
+
+    @tmp_repo_deco
+    def test_iter_deploy_tags(self):
+        """
+        Tests Sartoris::_iter_deploy_tags yields deploy tags newest first
+        from the end of the tag index and recovers from a corrupt index
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        make_commits(repo, 1)
+        tags = ['{0}-20130924-00000{1}'.format(config['user'], i)
+                for i in xrange(5)]
+        for tag in tags[:3] + ['other'] + tags[3:]:
+            s._dulwich_tag(tag, s._make_author())
+
+        assert list(s._iter_deploy_tags()) == tags[::-1]
+        assert s._get_latest_deploy_tag() == tags[-1]
+
+        path = s._get_tag_index().index_path
+        assert list(reverse_lines(path, block_size=7)) == \
+            open(path).read().splitlines()[::-1]
+
+        with open(path, 'a') as f:
+            f.write('corrupt\n')
+        assert list(islice(s._iter_deploy_tags(), 2)) == tags[:-3:-1]
+
+    @tmp_repo_deco
+    def test_journal(self):
+        """
+        Tests Sartoris::_write_journal records deploys, while the order of
+        deploys and deleted tags come from the tag index
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        head = make_commits(repo, 1)[-1]
+        tags = ['{0}-20130924-00000{1}'.format(config['user'], i)
+                for i in xrange(3)]
+        for tag in tags[:2]:
+            s._dulwich_tag(tag, s._make_author())
+
+        host = config['targets'][0]
+        s._tag = tags[2]
+        s._dulwich_tag(tags[2], s._make_author())
+        s._results = {host: {'exit_code': 0}}
+        s._write_journal('sync', 0, time())
+
+        s._tag = 'never-tagged'
+        s._results = None
+        s._write_journal('abort', 0, time())
+
+        records = list(s._get_journal().read_newest_first())
+        assert [r['action'] for r in records] == ['abort', 'sync']
+        assert records[0]['tag'] is None
+        assert records[1]['sha'] == head
+        assert records[1]['user'] == s.config['user']
+        assert records[1]['targets'] == dict(
+            (target, 'ok' if target == host else 'skipped')
+            for target in s.config['targets'])
+        assert s._get_journal().last_deploy(host)['tag'] == tags[2]
+        assert list(s._iter_deploy_tags()) == tags[::-1]
+
+        # A deleted tag is neither listed nor the last deploy
+        del repo.refs['refs/tags/' + tags[2]]
+        assert list(s._iter_deploy_tags()) == tags[1::-1]
+        try:
+            s.last_deploy(Namespace(host=host))
+            assert False
+        except SartorisError as e:
+            assert e.exit_code == 11
+
+    @tmp_repo_deco
+    def test_deploy_bundle(self):
+        """
+        Tests the bundle built by Sartoris::_build_deploy_bundle applies to
+        a repository at the previous deploy only
+        """
+        s = Sartoris()
+        repo = Repo(config['deploy.test_repo'])
+        first, second = ['{0}-20130924-00000{1}'.format(config['user'], i)
+                         for i in xrange(2)]
+
+        make_commits(repo, 1)
+        s._dulwich_tag(first, s._make_author())
+        target = mkdtemp()
+        try:
+            Popen(['git', 'clone', '-q', config['deploy.test_repo'],
+                   join(target, 'current')]).wait()
+            Repo.init(join(target, 'empty'), mkdir=True)
+
+            head = make_commits(repo, 2, timestamp=1380000010)[-1]
+            s._dulwich_tag(second, s._make_author())
+            bundle = s._build_deploy_bundle(second)
+
+            fetch = ['git', 'fetch', '-q', '--no-tags', bundle,
+                     '+refs/tags/{0}:refs/tags/{0}'.format(second)]
+            assert Popen(fetch, cwd=join(target, 'empty'),
+                         stderr=PIPE).wait() != 0
+            assert Popen(fetch, cwd=join(target, 'current')).wait() == 0
+            assert Repo(join(target, 'current'))[
+                'refs/tags/' + second].object[1] == head
+        finally:
+            rmtree(target)
+
     @setup_deco
     def test_dulwich_reset_to_tag(self):
         """
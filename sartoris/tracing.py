@@ -0,0 +1,145 @@
+"""
+Timing spans for git-deploy commands.
+
+Each phase of a command, e.g. loading the config, taking the lock or
+pulling to a target, is recorded as a span carrying its wall clock start
+and duration and its outcome.  The spans of a command share a trace id and
+are appended to a JSON lines file when the command finishes.  Only
+commands that change a deploy are traced unless a trace is asked for, and
+once the file outgrows MAX_TRACE_SIZE it is compacted to the spans of the
+newest KEEP_TRACES traces.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+import os
+import json
+from time import time
+from binascii import hexlify
+from threading import Lock
+from contextlib import contextmanager
+
+from config import log
+from files import reverse_lines, write_atomic
+
+OUTCOME_OK = 'ok'
+OUTCOME_ERROR = 'error'
+
+# Commands whose spans are written without --trace
+TRACED_COMMANDS = ('start', 'sync', 'abort', 'revert')
+
+# Compaction threshold in bytes and the traces kept by compaction
+MAX_TRACE_SIZE = 1024 * 1024
+KEEP_TRACES = 200
+
+
+def new_trace_id():
+    return hexlify(os.urandom(8))
+
+
+class Tracer(object):
+    """ Collects the spans of a command, safe to use from worker threads """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.trace_id = new_trace_id()
+        self.spans = []
+
+    def add(self, name, start, duration, outcome=OUTCOME_OK, **attrs):
+        """ Record a span that has already completed """
+        span = {
+            'name': name,
+            'start': round(start, 6),
+            'duration': round(duration, 6),
+            'outcome': outcome,
+        }
+        span.update(attrs)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        Time the enclosed block as a span.  The outcome is an error if the
+        block raises, the exception propagates.
+        """
+        start = time()
+        try:
+            yield
+        except BaseException as e:
+            self.add(name, start, time() - start, OUTCOME_ERROR,
+                     error=str(e) or e.__class__.__name__, **attrs)
+            raise
+        self.add(name, start, time() - start, OUTCOME_OK, **attrs)
+
+    def reset(self):
+        """ Drop the recorded spans and start a new trace """
+        with self._lock:
+            self.spans = []
+            self.trace_id = new_trace_id()
+
+    def write(self, path, command, max_size=MAX_TRACE_SIZE,
+              keep=KEEP_TRACES):
+        """
+        Append the spans as JSON lines to ``path``, each tagged with the
+        trace id and ``command``, compacting the file if it grew over
+        ``max_size``.  Returns the spans written.
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+
+        if spans:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'a') as f:
+                for span in spans:
+                    record = dict(span, trace=self.trace_id, command=command)
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+
+            if os.path.getsize(path) > max_size:
+                compact(path, keep)
+        return spans
+
+
+def compact(path, keep=KEEP_TRACES):
+    """ Rewrite the trace log at ``path`` with its newest ``keep`` traces """
+    kept = []
+    traces = set()
+    for line in reverse_lines(path):
+        try:
+            trace = json.loads(line)['trace']
+        except (ValueError, TypeError, KeyError):
+            continue
+        if trace not in traces:
+            if len(traces) == keep:
+                break
+            traces.add(trace)
+        kept.append(line)
+
+    log.info('{0} :: Compacted the trace log to {1} trace(s)'.format(
+        __name__, len(traces)))
+    write_atomic(path, ''.join(line + '\n' for line in reversed(kept)))
+
+
+def summarize(spans):
+    """ Lines of a table of the spans, in start order, with a total """
+    lines = ['{0:<14} {1:<30} {2:>9} {3}'.format(
+        'phase', 'host', 'duration', 'outcome')]
+    for span in sorted(spans, key=lambda span: span['start']):
+        lines.append('{0:<14} {1:<30} {2:>8.3f}s {3}'.format(
+            span['name'], span.get('host', ''), span['duration'],
+            span['outcome']))
+
+    if spans:
+        start = min(span['start'] for span in spans)
+        end = max(span['start'] + span['duration'] for span in spans)
+        lines.append('{0:<14} {1:<30} {2:>8.3f}s'.format('total', '',
+                                                         end - start))
+    return lines
@@ -0,0 +1,72 @@
+"""
+Rolling deploys.
+
+Targets are updated in waves: an optional canary set first, then batches
+of a fixed number or percentage of the fleet.  Between waves the deploy
+pauses or runs a health check, and it halts once the failure rate of a
+wave exceeds the allowed maximum, leaving the remaining targets untouched.
+"""
+
+__authors__ = {
+    'Ryan Faulkner': 'bobs.ur.uncle@gmail.com',
+    'Patrick Reilly': 'patrick.reilly@gmail.com',
+    'Ryan Lane': 'rlane@wikimedia.org',
+}
+__date__ = '2013-09-08'
+__license__ = 'GPL v2.0 (or later)'
+
+from math import ceil
+
+from fanout import failed_hosts
+
+PERCENT = '%'
+
+
+def parse_count(value, total):
+    """
+    Parse a host count, either a number or a percentage of ``total`` such
+    as "10%".  A non-zero percentage is at least one host.
+    """
+    value = str(value or 0).strip()
+    if value.endswith(PERCENT):
+        percent = float(value[:-len(PERCENT)])
+        return int(ceil(total * percent / 100)) if percent > 0 else 0
+    return max(int(value), 0)
+
+
+def parse_rate(value):
+    """ Parse a failure rate, a fraction such as "0.1" or a percentage """
+    value = str(value or 0).strip()
+    if value.endswith(PERCENT):
+        return float(value[:-len(PERCENT)]) / 100
+    return float(value)
+
+
+def plan_waves(hosts, canary, wave_size):
+    """
+    Split ``hosts`` into waves, in order.  The first ``canary`` hosts form
+    a wave of their own, the rest are split into waves of ``wave_size``
+    hosts, all in one wave if it is 0.  Both are counts or percentages of
+    the number of hosts.
+    """
+    hosts = list(hosts)
+    total = len(hosts)
+    waves = []
+
+    canary = parse_count(canary, total)
+    if canary:
+        waves.append(hosts[:canary])
+        hosts = hosts[canary:]
+
+    size = parse_count(wave_size, total) or len(hosts)
+    while hosts:
+        waves.append(hosts[:size])
+        hosts = hosts[size:]
+    return waves
+
+
+def failure_rate(results):
+    """ Fraction of the hosts in the results of a wave that failed """
+    if not results:
+        return 0.0
+    return float(len(failed_hosts(results))) / len(results)
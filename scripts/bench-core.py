@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    bench-core
+    ~~~~~~~~~~
+
+    Measures how the core repository operations of git-deploy scale.
+
+    Synthetic repositories are generated for every combination of the
+    given commit, tag, file and file size counts.  Against each one the tag
+    listing, tag resolution, diff, status, staging and revert paths are
+    timed in-process and reported as one JSON object per operation and
+    repository.  Operations with caches are measured both cold, with the
+    caches dropped before each run, and warm.
+
+    With --latency the remote paths, the lock helpers, SCP and the target
+    pull, are timed as well against an in-process SSH server that adds the
+    given latency to every round trip.
+
+    With --baseline the results are compared to a previous run and the
+    script exits non-zero if the best time of any operation regressed by
+    more than --tolerance.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+USER = 'bench'
+
+AUTHOR = 'Bench <bench@example.com>'
+
+# Seconds since the epoch of the first synthetic commit
+EPOCH = 1380000000
+
+# Files are spread over this many directories
+DIRECTORIES = 10
+
+GITCONFIG = """[user]
+    name = Bench
+    email = bench@example.com
+[deploy]
+    target = 127.0.0.1:1
+    path = {repo}/
+    user = {user}
+    hook-dir = .git/deploy/hooks/
+    tag-prefix = bench
+    remote = origin
+    branch = master
+    client-path = {repo}/
+    key-path = {home}/id_rsa
+    test-repo-path = {repo}/
+"""
+
+
+def file_contents(path, revision, size):
+    """ Text contents of ``size`` bytes that differ per revision """
+    head = '{0} revision {1}\n'.format(path, revision)
+    line = 'the quick brown fox jumps over the lazy dog {0}\n'.format(path)
+    body = line * (max(size - len(head), 0) // len(line) + 1)
+    return head + body[:max(size - len(head), 0)]
+
+
+def make_repo(path, commits, tags, files, file_size):
+    """
+    Generate a repository of ``commits`` commits, each changing 1% of the
+    ``files`` files, with ``tags`` annotated deploy tags spread evenly over
+    the history.  The working tree and index are checked out at the last
+    commit.  Returns the deploy tags, oldest first.
+    """
+    from dulwich.repo import Repo
+    from dulwich.objects import Blob, Commit, Tag
+    from dulwich.object_store import MemoryObjectStore
+    from dulwich.index import commit_tree, build_index_from_tree
+
+    repo = Repo.init(path)
+    store = MemoryObjectStore()
+    rand = random.Random(0)
+
+    names = ['dir{0}/file{1}.txt'.format(i % DIRECTORIES, i)
+             for i in xrange(files)]
+    blobs = {}
+    for name in names:
+        blob = Blob.from_string(file_contents(name, 0, file_size))
+        store.add_object(blob)
+        blobs[name] = blob.id
+
+    shas = []
+    for i in xrange(commits):
+        if i:
+            for name in rand.sample(names, max(1, files // 100)):
+                blob = Blob.from_string(file_contents(name, i, file_size))
+                store.add_object(blob)
+                blobs[name] = blob.id
+
+        commit = Commit()
+        commit.tree = commit_tree(store, [(name, sha, 0100644) for
+                                          name, sha in blobs.iteritems()])
+        commit.parents = shas[-1:]
+        commit.author = commit.committer = AUTHOR
+        commit.author_time = commit.commit_time = EPOCH + i * 60
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.message = 'commit {0}\n'.format(i)
+        store.add_object(commit)
+        shas.append(commit.id)
+
+    tag_names = []
+    for i in xrange(min(tags, commits)):
+        commit = store[shas[(i + 1) * commits // min(tags, commits) - 1]]
+        tag = Tag()
+        tag.name = '{0}-{1}'.format(USER, time.strftime(
+            '%Y%m%d-%H%M%S', time.gmtime(commit.commit_time)))
+        tag.tagger = AUTHOR
+        tag.message = 'Sartoris Tag.'
+        tag.object = (Commit, commit.id)
+        tag.tag_time = commit.commit_time
+        tag.tag_timezone = 0
+        store.add_object(tag)
+        tag_names.append(tag.name)
+        repo.refs['refs/tags/' + tag.name] = tag.id
+
+    repo.object_store.add_objects([(store[sha], None) for sha in store])
+    repo.refs['refs/heads/master'] = shas[-1]
+    build_index_from_tree(repo.path, repo.index_path(), repo.object_store,
+                          store[shas[-1]].tree)
+
+    # Rewrite the index once the checkout is in the past so that files are
+    # not treated as racily clean
+    time.sleep(1.1)
+    repo.open_index().write()
+    return tag_names
+
+
+def time_runs(func, repeat, setup=None):
+    """ Returns the wall clock seconds of ``repeat`` runs of ``func`` """
+    times = []
+    for _ in xrange(repeat):
+        if setup:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return times
+
+
+def drop_caches(s):
+    """ Drop the repository handle, peeled tags and on-disk tag index """
+    s._repo = None
+    s._peeled_tags = {}
+    s._get_tag_index().invalidate()
+
+
+def touch_files(repo_path, count):
+    """ Modify ``count`` files of the working tree """
+    names = []
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = [d for d in dirs if d != '.git']
+        names.extend(os.path.join(root, name) for name in files)
+    for name in sorted(names)[:count]:
+        with open(name, 'a') as f:
+            f.write('modified\n')
+
+
+def bench_repo(s, repo_path, tags, files, repeat):
+    """ Time the core operations against one repository """
+    from sartoris.sartoris import Sartoris
+
+    s.config['top_dir'] = repo_path
+    os.chdir(repo_path)
+    drop_caches(s)
+
+    class DiffArgs(object):
+        name_only = False
+        stat = False
+
+    def diff():
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            Sartoris.diff(s, DiffArgs())
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    def resolve_tags():
+        for tag in tags:
+            s._get_commit_sha_for_tag(tag)
+
+    revert_targets = itertools.cycle([
+        s._get_commit_sha_for_tag(tags[0]),
+        s._get_repo().head()])
+
+    def revert():
+        s._dulwich_revert_to_commit(next(revert_targets), AUTHOR, 'revert')
+
+    operations = [
+        ('get_tags_cold', s._dulwich_get_tags, lambda: drop_caches(s)),
+        ('get_tags', s._dulwich_get_tags, None),
+        ('commit_sha_for_tag_cold', resolve_tags, lambda: drop_caches(s)),
+        ('commit_sha_for_tag', resolve_tags, None),
+        ('diff', diff, None),
+        ('status', s._dulwich_status, None),
+        ('stage_all_clean', s._dulwich_stage_all, None),
+        ('stage_all_dirty', s._dulwich_stage_all,
+         lambda: touch_files(repo_path, max(1, files // 100))),
+        ('revert', revert, None),
+    ]
+
+    results = []
+    for name, func, setup in operations:
+        times = time_runs(func, repeat, setup)
+        results.append({
+            'operation': name,
+            'first_ms': round(times[0] * 1000, 2),
+            'best_ms': round(min(times) * 1000, 2),
+            'runs': len(times),
+        })
+    return results
+
+
+def bench_remote(s, sandbox, latency, repeat):
+    """ Time the remote operations against a local SSH stand-in """
+    import paramiko
+    from ssh_server import SSHStandIn
+    from sartoris.config import DEFAULT_TARGET_HOOK
+
+    server = SSHStandIn(sandbox, latency=latency).start()
+    key_path = os.path.join(os.path.dirname(sandbox), 'id_rsa')
+    paramiko.RSAKey.generate(1024).write_private_key_file(key_path)
+
+    saved = dict(s.config)
+    s.config.update(target=server.target, targets=[server.target],
+                    path=sandbox + '/')
+    s.config['deploy.key_path'] = key_path
+    s._ssh_pool = None
+
+    hook_dir = os.path.join(sandbox, s.config['hook_dir'])
+    os.makedirs(hook_dir)
+    with open(os.path.join(hook_dir, DEFAULT_TARGET_HOOK), 'w') as f:
+        f.write('#!/bin/sh\n')
+    os.chmod(os.path.join(hook_dir, DEFAULT_TARGET_HOOK), 0755)
+
+    artifact = os.path.join(os.path.dirname(sandbox), 'artifact')
+    with open(artifact, 'wb') as f:
+        f.write(os.urandom(1024 * 1024))
+
+    def lock_cycle():
+        s._acquire_lock()
+        s._check_lock()
+        s._remove_lock()
+
+    def scp():
+        s.scp_files([(artifact, os.path.join(sandbox, 'artifact'))])
+
+    operations = [
+        ('connect', lambda: s.ssh_command_target('true'),
+         lambda: setattr(s, '_ssh_pool', None)),
+        ('lock_cycle', lock_cycle, None),
+        ('scp_1mb', scp, None),
+        ('target_pull', lambda: s._pull_targets('tag'), None),
+    ]
+
+    results = []
+    try:
+        for name, func, setup in operations:
+            commands = len(server.commands)
+            times = time_runs(func, repeat, setup)
+            results.append({
+                'operation': name,
+                'first_ms': round(times[0] * 1000, 2),
+                'best_ms': round(min(times) * 1000, 2),
+                'runs': len(times),
+                'round_trips': (len(server.commands) - commands) // repeat,
+                'latency_ms': latency * 1000,
+            })
+    finally:
+        s._get_ssh_pool().close()
+        s._ssh_pool = None
+        s.config.clear()
+        s.config.update(saved)
+        server.stop()
+    return results
+
+
+def bench(scenarios, repeat, latency=None):
+    path = tempfile.mkdtemp(prefix='git-deploy-bench-')
+    cwd = os.getcwd()
+    try:
+        home = os.path.join(path, 'home')
+        os.mkdir(home)
+        first_repo = os.path.join(path, 'repo-0')
+        with open(os.path.join(home, '.gitconfig'), 'w') as f:
+            f.write(GITCONFIG.format(repo=first_repo, home=home, user=USER))
+        os.environ['HOME'] = home
+
+        results = []
+        for number, (commits, tags, files, file_size) in \
+                enumerate(scenarios):
+            repo_path = os.path.join(path, 'repo-{0}'.format(number))
+            os.mkdir(repo_path)
+            start = time.time()
+            tag_names = make_repo(repo_path, commits, tags, files, file_size)
+            sys.stderr.write('Generated {0} commits, {1} tags, {2} files of '
+                             '{3} bytes in {4:.1f}s\n'.format(
+                                 commits, tags, files, file_size,
+                                 time.time() - start))
+
+            os.chdir(repo_path)
+            from sartoris.sartoris import Sartoris
+            s = Sartoris()
+
+            scenario = {'commits': commits, 'tags': tags, 'files': files,
+                        'file_size': file_size}
+            for result in bench_repo(s, repo_path, tag_names, files, repeat):
+                result.update(scenario)
+                results.append(result)
+
+        if latency is not None:
+            sandbox = os.path.join(path, 'remote', 'target')
+            os.makedirs(os.path.join(sandbox, '.git', 'deploy'))
+            results.extend(bench_remote(s, sandbox, latency, repeat))
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path)
+
+
+def result_key(result):
+    return (result['operation'], result.get('commits'), result.get('tags'),
+            result.get('files'), result.get('file_size'),
+            result.get('latency_ms'))
+
+
+def regressions(results, baseline_path, tolerance):
+    """ Returns the operations whose best time regressed on the baseline """
+    with open(baseline_path) as f:
+        baseline = dict((result_key(r), r) for r in
+                        (json.loads(line) for line in f if line.strip()))
+
+    regressed = []
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if previous and \
+                result['best_ms'] > previous['best_ms'] * (1 + tolerance):
+            regressed.append(result['operation'])
+    return regressed
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(
+        description="Measure the core git-deploy operations on synthetic "
+                    "repositories.")
+    parser.add_argument("-c", "--commits", nargs='+', default=[200],
+                        type=int, help="commits per repository")
+    parser.add_argument("-T", "--tags", nargs='+', default=[50], type=int,
+                        help="deploy tags per repository")
+    parser.add_argument("-f", "--files", nargs='+', default=[500], type=int,
+                        help="files per repository")
+    parser.add_argument("-s", "--file-size", nargs='+', default=[4096],
+                        type=int, help="bytes per file")
+    parser.add_argument("-l", "--latency", default=None, type=float,
+                        help="also time the remote paths with this round "
+                             "trip latency in seconds")
+    parser.add_argument("-r", "--repeat", default=5, type=int,
+                        help="runs per operation")
+    parser.add_argument("-b", "--baseline", default=None,
+                        help="JSON lines output of a previous run")
+    parser.add_argument("-t", "--tolerance", default=0.25, type=float,
+                        help="allowed fractional regression of best times")
+    return parser.parse_args()
+
+
+def main():
+    args = parseargs()
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, 'sartoris', 'tests'))
+
+    scenarios = list(itertools.product(args.commits, args.tags, args.files,
+                                       args.file_size))
+    results = bench(scenarios, args.repeat, args.latency)
+
+    for result in results:
+        print json.dumps(result, sort_keys=True)
+
+    if args.baseline:
+        regressed = regressions(results, args.baseline, args.tolerance)
+        if regressed:
+            sys.stderr.write('Regressed: {0}\n'.format(', '.join(regressed)))
+            return 1
+    return 0
+
+
+def cli():
+    sys.exit(main())
+
+if __name__ == "__main__":  # pragma: nocover
+    cli()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    bench-startup
+    ~~~~~~~~~~~~~
+
+    Measures the cold start cost of each git-deploy command.
+
+    Every command is run in a fresh interpreter against a throwaway
+    repository and configuration.  The time spent importing modules, the
+    total wall clock time and the heavy modules that were loaded are
+    reported as one JSON object per line.  Remote commands are pointed at
+    an unreachable target so they fail fast once their imports are done.
+
+    With --baseline the results are compared to a previous run and the
+    script exits non-zero if the import time of any command regressed by
+    more than --tolerance.
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+GIT_DEPLOY = os.path.join(ROOT, 'sartoris', 'git-deploy')
+
+COMMANDS = ['show_tag', 'log_deploys', 'diff', 'start', 'sync', 'abort',
+            'revert']
+
+# Modules whose presence after start up is reported
+HEAVY_MODULES = ['paramiko', 'Crypto', 'multiprocessing', 'dulwich.index',
+                 'dulwich.patch']
+
+USER = 'bench'
+
+GITCONFIG = """[user]
+    name = Bench
+    email = bench@example.com
+[deploy]
+    target = 127.0.0.1:1
+    path = {repo}/
+    user = {user}
+    hook-dir = .git/deploy/hooks/
+    tag-prefix = bench
+    remote = origin
+    branch = master
+    client-path = {repo}/
+    key-path = {home}/id_rsa
+    test-repo-path = {repo}/
+"""
+
+# Run in the child interpreter, times imports and dispatches the command
+SNIPPET = """
+import sys, json, time, __builtin__
+start = time.time()
+state = {'depth': 0, 'imports': 0.0}
+real_import = __builtin__.__import__
+
+def timed_import(*args, **kwargs):
+    state['depth'] += 1
+    t = time.time()
+    try:
+        return real_import(*args, **kwargs)
+    finally:
+        state['depth'] -= 1
+        if not state['depth']:
+            state['imports'] += time.time() - t
+
+__builtin__.__import__ = timed_import
+sys.argv = ['git-deploy', sys.argv[1], '-s']
+scope = {'__name__': 'git_deploy'}
+execfile(%(git_deploy)r, scope)
+try:
+    scope['main']()
+except BaseException:
+    pass
+wall = time.time() - start
+
+with open(%(result)r, 'w') as f:
+    json.dump({
+        'command': sys.argv[1],
+        'import_ms': round(state['imports'] * 1000, 2),
+        'wall_ms': round(wall * 1000, 2),
+        'modules': len([m for m in sys.modules.values() if m]),
+        'heavy': [m for m in %(heavy)r if m in sys.modules],
+    }, f)
+"""
+
+
+def make_fixture(path):
+    """ Create a repository with two deploy tags and its git config """
+    from dulwich.repo import Repo
+
+    home = os.path.join(path, 'home')
+    repo_path = os.path.join(path, 'repo')
+    os.mkdir(home)
+    os.mkdir(repo_path)
+
+    with open(os.path.join(home, '.gitconfig'), 'w') as f:
+        f.write(GITCONFIG.format(repo=repo_path, home=home, user=USER))
+
+    repo = Repo.init(repo_path)
+    for i in xrange(2):
+        with open(os.path.join(repo_path, 'file.txt'), 'w') as f:
+            f.write('revision {0}\n'.format(i))
+        repo.stage(['file.txt'])
+        sha = repo.do_commit('commit {0}'.format(i),
+                             committer='Bench <bench@example.com>',
+                             commit_timestamp=1380000000 + i,
+                             commit_timezone=0)
+        repo.refs['refs/tags/{0}-20130924-00000{1}'.format(USER, i)] = sha
+
+    return home, repo_path
+
+
+def run_command(command, home, repo_path, result_path):
+    env = dict(os.environ)
+    env['HOME'] = home
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + filter(None, [env.get('PYTHONPATH')]))
+
+    snippet = SNIPPET % {'git_deploy': GIT_DEPLOY,
+                         'result': result_path,
+                         'heavy': HEAVY_MODULES}
+
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call([sys.executable, '-c', snippet, command],
+                        cwd=repo_path, env=env, stdout=devnull,
+                        stderr=devnull)
+
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def bench(commands, repeat):
+    """ Returns the fastest of ``repeat`` runs for each command """
+    path = tempfile.mkdtemp(prefix='git-deploy-bench-')
+    try:
+        home, repo_path = make_fixture(path)
+        result_path = os.path.join(path, 'result.json')
+        results = []
+        for command in commands:
+            runs = [run_command(command, home, repo_path, result_path)
+                    for _ in xrange(repeat)]
+            results.append(min(runs, key=lambda r: r['import_ms']))
+        return results
+    finally:
+        shutil.rmtree(path)
+
+
+def regressions(results, baseline_path, tolerance):
+    """ Returns the commands whose import time regressed on the baseline """
+    with open(baseline_path) as f:
+        baseline = dict((r['command'], r) for r in
+                        (json.loads(line) for line in f if line.strip()))
+
+    regressed = []
+    for result in results:
+        previous = baseline.get(result['command'])
+        if previous and \
+                result['import_ms'] > previous['import_ms'] * (1 + tolerance):
+            regressed.append(result['command'])
+    return regressed
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(
+        description="Measure git-deploy start up time per command.")
+    parser.add_argument("commands", nargs='*', default=COMMANDS,
+                        help="commands to measure, default all")
+    parser.add_argument("-r", "--repeat", default=5, type=int,
+                        help="runs per command, the fastest is reported")
+    parser.add_argument("-b", "--baseline", default=None,
+                        help="JSON lines output of a previous run")
+    parser.add_argument("-t", "--tolerance", default=0.25, type=float,
+                        help="allowed fractional import time regression")
+    return parser.parse_args()
+
+
+def main():
+    args = parseargs()
+    results = bench(args.commands, args.repeat)
+
+    for result in results:
+        print json.dumps(result, sort_keys=True)
+
+    if args.baseline:
+        regressed = regressions(results, args.baseline, args.tolerance)
+        if regressed:
+            sys.stderr.write('Import time regressed for: {0}\n'.format(
+                ', '.join(regressed)))
+            return 1
+    return 0
+
+
+def cli():
+    sys.exit(main())
+
+if __name__ == "__main__":  # pragma: nocover
+    cli()